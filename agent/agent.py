@@ -7,11 +7,546 @@ import subprocess
 import datetime
 import os
 import getpass
+import time
+import random
+import signal
+import argparse
+import threading
+import hashlib
+import gzip
+import struct
+import gc
+import functools
+import re
+from collections import deque
+from contextlib import contextmanager
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime
 
-SERVER_URL = "http://192.168.32.87:5000"
+# Optional: compact request bodies when both ends have them installed.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Point this at the backend's ingest port (INGEST_PORT, 5001) when it runs one
+SERVER_URL = os.environ.get("AGENT_SERVER_URL", "http://192.168.32.87:5000")
 DEVICE_ID = socket.gethostname()
+STATE_DIR = os.environ.get("AGENT_STATE_DIR", os.path.expanduser("~/.cache/monitoring-agent"))
+
+# ---------------- SELF PROFILING ----------------
+# Every collector and HTTP call records its wall time, thread CPU time,
+# subprocesses spawned, bytes sent and the agent's RSS afterwards. The last
+# PROFILE_WINDOW samples per name are summarised into percentiles and a
+# wall-time histogram and sent to the backend with the device report.
+
+PROFILE_WINDOW = 256
+WALL_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 30000)
+
+profile_context = threading.local()
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+class Profiler:
+    def __init__(self, window=PROFILE_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}    # name -> deque of (wall_ms, cpu_ms, subprocesses, bytes, rss)
+        self.process = psutil.Process()
+
+    @contextmanager
+    def measure(self, name):
+        stack = getattr(profile_context, "stack", None)
+        if stack is None:
+            stack = profile_context.stack = []
+        frame = {"subprocesses": 0, "bytes": 0}
+        stack.append(frame)
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield frame
+        finally:
+            stack.pop()
+            sample = (
+                (time.perf_counter() - wall) * 1000,
+                (time.thread_time() - cpu) * 1000,
+                frame["subprocesses"],
+                frame["bytes"],
+                self.process.memory_info().rss,
+            )
+            with self.lock:
+                self.samples.setdefault(name, deque(maxlen=self.window)).append(sample)
+
+    def count(self, key, amount=1):
+        # Costs are inclusive: they count towards every call on the stack.
+        for frame in getattr(profile_context, "stack", ()):
+            frame[key] += amount
+
+    def summary(self):
+        with self.lock:
+            samples = {name: list(window) for name, window in self.samples.items()}
+        result = {}
+        for name, rows in samples.items():
+            walls = [r[0] for r in rows]
+            cpus = [r[1] for r in rows]
+            histogram = [0] * (len(WALL_BUCKETS_MS) + 1)
+            for wall in walls:
+                histogram[next((i for i, edge in enumerate(WALL_BUCKETS_MS) if wall <= edge), len(WALL_BUCKETS_MS))] += 1
+            result[name] = {
+                "count": len(rows),
+                "wall_ms": {"p50": round(percentile(walls, 50), 2), "p95": round(percentile(walls, 95), 2),
+                            "max": round(max(walls), 2)},
+                "cpu_ms": {"avg": round(sum(cpus) / len(cpus), 2), "max": round(max(cpus), 2)},
+                "subprocesses": sum(r[2] for r in rows),
+                "bytes_sent": sum(r[3] for r in rows),
+                "rss_mb": round(max(r[4] for r in rows) / (1024 ** 2), 1),
+                "histogram": histogram,
+            }
+        return {"window": self.window, "buckets_ms": list(WALL_BUCKETS_MS), "collectors": result}
+
+profiler = Profiler()
+
+def profiled(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with profiler.measure(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+# ---------------- HTTP CLIENT ----------------
+
+HTTP_TIMEOUT = (3.05, 30)        # (connect, read) seconds
+HTTP_RETRIES = 2
+HTTP_BACKOFF = 0.5               # seconds, doubled per retry
+HTTP_COMPRESS_MIN = 1024         # compress request bodies larger than this
+RETRY_STATUSES = (502, 503, 504)
+MSGPACK_MIMETYPE = "application/msgpack"
+
+def encode_body(payload, accepted=()):
+    """Serialise a request body in the most compact form the backend accepts.
+    `accepted` comes from its X-Accept-Body header; JSON with gzip is the
+    fallback every backend understands."""
+    if msgpack is not None and "msgpack" in accepted:
+        data = msgpack.packb(payload, use_bin_type=True)
+        headers = {"Content-Type": MSGPACK_MIMETYPE}
+    else:
+        data = json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json"}
+    if len(data) > HTTP_COMPRESS_MIN:
+        if zstandard is not None and "zstd" in accepted:
+            data = zstandard.ZstdCompressor(level=3).compress(data)
+            headers["Content-Encoding"] = "zstd"
+        else:
+            data = gzip.compress(data, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+    return data, headers
+
+class AgentClient:
+    """Shared keep-alive session for all collectors, with timeouts, bounded
+    retries, negotiated compact request bodies and transport health counters."""
+
+    def __init__(self, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=8)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip"})
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "failures": 0, "retries": 0, "bytes_sent": 0,
+                      "latency_total_ms": 0.0, "latency_max_ms": 0.0}
+        # Body encodings the backend advertised on its last response.
+        self.accepted = frozenset()
+
+    def learn_encodings(self, res):
+        advertised = res.headers.get("X-Accept-Body")
+        if advertised is not None:
+            self.accepted = frozenset(e.strip() for e in advertised.split(",") if e.strip())
+
+    def encoding(self):
+        data, headers = encode_body({"probe": "x" * HTTP_COMPRESS_MIN}, self.accepted)
+        return f"{headers['Content-Type'].split('/')[1]}+{headers['Content-Encoding']}"
+
+    def _record(self, latency_ms, failed=False, retried=False, sent=0):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["failures"] += int(failed)
+            self.stats["retries"] += int(retried)
+            self.stats["bytes_sent"] += sent
+            self.stats["latency_total_ms"] += latency_ms
+            self.stats["latency_max_ms"] = max(self.stats["latency_max_ms"], latency_ms)
+
+    def health(self):
+        with self.lock:
+            stats = dict(self.stats)
+        count = stats.pop("requests")
+        total = stats.pop("latency_total_ms")
+        return {
+            "requests": count,
+            "encoding": self.encoding(),
+            "avg_latency_ms": round(total / count, 1) if count else 0.0,
+            **{k: round(v, 1) if isinstance(v, float) else v for k, v in stats.items()},
+        }
+
+    def request(self, method, url, json=None, timeout=None, retries=None, **kwargs):
+        route = re.sub(r"^.*/api/devices/[^/]+/", "", url)
+        with profiler.measure(f"http {method} {route}"):
+            return self._request(method, url, json, timeout, retries, **kwargs)
+
+    def _encode(self, payload, headers):
+        data, body_headers = encode_body(payload, self.accepted)
+        headers.pop("Content-Encoding", None)
+        headers.update(body_headers)
+        profiler.count("bytes", len(data))
+        return data
+
+    def _request(self, method, url, json, timeout, retries, **kwargs):
+        headers = dict(kwargs.pop("headers", None) or {})
+        data = self._encode(json, headers) if json is not None else None
+
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                res = self.session.request(method, url, data=data, headers=headers,
+                                           timeout=timeout or self.timeout, **kwargs)
+            except requests.RequestException:
+                self._record((time.monotonic() - started) * 1000, failed=True,
+                             retried=attempt < retries, sent=len(data or b""))
+                if attempt >= retries:
+                    raise
+            else:
+                self.learn_encodings(res)
+                if res.status_code == 415 and json is not None and headers["Content-Type"] != "application/json":
+                    # The backend no longer takes what it advertised (e.g. after
+                    # a rollback): resend as JSON straight away.
+                    self._record((time.monotonic() - started) * 1000, retried=True, sent=len(data))
+                    self.accepted = frozenset()
+                    data = self._encode(json, headers)
+                    continue
+                retry = res.status_code in RETRY_STATUSES and attempt < retries
+                self._record((time.monotonic() - started) * 1000, failed=res.status_code >= 500,
+                             retried=retry, sent=len(data or b""))
+                if not retry:
+                    return res
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, json=None, **kwargs):
+        return self.request("POST", url, json=json, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+http = AgentClient()
+
+# ---------------- LOCAL STATE ----------------
+
+def load_state(name, default=None):
+    try:
+        with open(os.path.join(STATE_DIR, f"{name}.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_state(name, data):
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        path = os.path.join(STATE_DIR, f"{name}.json")
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[Agent] Failed to save state '{name}': {e}")
+
+# ---------------- METRICS SAMPLER ----------------
+
+SAMPLE_INTERVAL = 1.0
+# Ring buffer of per-tick readings that reports are aggregated from: one hour
+# at the default interval, so spikes between reports are not lost.
+SAMPLE_HISTORY = 3600
+AGGREGATED_METRICS = ("cpu", "ram", "disk")
+PROCESS_WATCH_TTL = 900   # stop sampling a PID nobody has asked about for this long
+
+class MetricsSampler:
+    """Background thread that keeps the latest CPU, memory, disk and per-PID
+    CPU readings, computed as deltas of cumulative counters between ticks.
+    Collectors read the most recent window instead of sleeping to measure."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.ticks = 0
+        self.latest_sample = {}
+        self.history = deque(maxlen=SAMPLE_HISTORY)
+        self.procs = {}          # pid -> psutil.Process, primed for cpu_percent
+        self.proc_usage = {}     # pid -> (cpu percent, rss bytes)
+        self.last_wanted = {}    # pid -> monotonic time of last request
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        with self.cond:
+            if self.thread is not None:
+                return
+            psutil.cpu_percent(None)
+            self.thread = threading.Thread(target=self._run, name="metrics-sampler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"[Agent] Metrics sampling failed: {e}")
+
+    def sample(self):
+        cpu = psutil.cpu_percent(None)
+        mem = psutil.virtual_memory()
+        disk = psutil.disk_usage('/')
+
+        now = time.monotonic()
+        with self.cond:
+            for pid in [pid for pid, t in self.last_wanted.items() if now - t > PROCESS_WATCH_TTL]:
+                self.procs.pop(pid, None)
+                self.last_wanted.pop(pid, None)
+            procs = list(self.procs.items())
+
+        usage = {}
+        for pid, p in procs:
+            try:
+                usage[pid] = (p.cpu_percent(None), p.memory_info().rss)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+        with self.cond:
+            for pid, _ in procs:
+                if pid not in usage:
+                    self.procs.pop(pid, None)
+            self.proc_usage = usage
+            self.latest_sample = {
+                "time": time.time(),
+                "cpu": cpu,
+                "ram": mem.percent,
+                "ram_used": mem.used,
+                "ram_total": mem.total,
+                "disk": disk.percent,
+                "disk_used": disk.used,
+                "disk_total": disk.total,
+            }
+            self.history.append(tuple(self.latest_sample[k] for k in ("time",) + AGGREGATED_METRICS))
+            self.ticks += 1
+            self.cond.notify_all()
+
+    def wait_for_tick(self, after):
+        with self.cond:
+            self.cond.wait_for(lambda: self.ticks > after, self.interval * 3)
+
+    def latest(self):
+        """Latest system-wide window; only blocks before the very first tick."""
+        self.start()
+        self.wait_for_tick(0)
+        with self.cond:
+            return dict(self.latest_sample)
+
+    def aggregate(self, since):
+        """min/max/mean/p95/last per metric over the ticks after `since`
+        (a time.time() value), or None when there are none. "until" is the
+        time of the newest tick included."""
+        with self.cond:
+            rows = [row for row in self.history if row[0] > since]
+        if not rows:
+            return None
+        result = {
+            "until": rows[-1][0],
+            "window_seconds": round(rows[-1][0] - rows[0][0] + self.interval, 1),
+            "samples": len(rows),
+        }
+        for i, metric in enumerate(AGGREGATED_METRICS, start=1):
+            values = [row[i] for row in rows]
+            result[metric] = {
+                "min": min(values),
+                "max": max(values),
+                "mean": round(sum(values) / len(values), 2),
+                "p95": percentile(values, 95),
+                "last": values[-1],
+            }
+        return result
+
+    def process_usage(self, pids):
+        """CPU percent and RSS per PID. PIDs not sampled yet are primed now and
+        read on the next tick, so a batch of new PIDs costs one shared wait."""
+        self.start()
+        now = time.monotonic()
+        new = False
+        with self.cond:
+            tick = self.ticks
+            for pid in set(pids):
+                self.last_wanted[pid] = now
+                if pid in self.procs:
+                    continue
+                try:
+                    p = psutil.Process(pid)
+                    p.cpu_percent(None)
+                    self.procs[pid] = p
+                    new = True
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+        if new:
+            self.wait_for_tick(tick)
+        with self.cond:
+            return {pid: self.proc_usage[pid] for pid in pids if pid in self.proc_usage}
+
+sampler = MetricsSampler()
 
+# ---------------- COLLECTOR EXECUTOR ----------------
+# Collectors run on a small bounded pool, each against a deadline. Every child
+# process is started through run_command(), which records it under the
+# collector that spawned it; when a collector overruns, its children are
+# killed and the overrun is counted and reported to the backend.
+
+COMMAND_TIMEOUT = 120
+COLLECTOR_WORKERS = 6
+
+collector_context = threading.local()
+
+class CollectorTimeout(Exception):
+    pass
+
+class CollectorBusy(Exception):
+    pass
+
+def kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def run_command(args, timeout=COMMAND_TIMEOUT, check=False, capture_output=False, **kwargs):
+    """subprocess.run() replacement: always has a timeout, runs the child in its
+    own process group (so `sh -c` pipelines die together) and registers it
+    with the collector executor."""
+    if capture_output:
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["stderr"] = subprocess.PIPE
+    profiler.count("subprocesses")
+    with subprocess.Popen(args, start_new_session=True, **kwargs) as proc:
+        executor.track(proc)
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_group(proc)
+            proc.communicate()
+            raise
+        finally:
+            executor.untrack(proc)
+    result = subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+    if check:
+        result.check_returncode()
+    return result
+
+class CollectorExecutor:
+    def __init__(self, max_workers=COLLECTOR_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="collector")
+        self.lock = threading.Lock()
+        self.children = {}       # collector name -> set of Popen
+        self.running = {}        # collector name -> Future
+        self.overruns = {}       # collector name -> {"count", "timeout", "last"}
+
+    def track(self, proc):
+        name = getattr(collector_context, "name", None)
+        if name:
+            with self.lock:
+                self.children.setdefault(name, set()).add(proc)
+
+    def untrack(self, proc):
+        name = getattr(collector_context, "name", None)
+        if name:
+            with self.lock:
+                self.children.get(name, set()).discard(proc)
+
+    def _call(self, name, fn, args):
+        collector_context.name = name
+        try:
+            return fn(*args)
+        finally:
+            collector_context.name = None
+            with self.lock:
+                self.running.pop(name, None)
+
+    def submit(self, name, fn, *args):
+        with self.lock:
+            if name in self.running:
+                raise CollectorBusy(name)
+            future = self.pool.submit(self._call, name, fn, args)
+            self.running[name] = future
+        return future
+
+    def overrun(self, name, timeout):
+        with self.lock:
+            children = list(self.children.get(name, ()))
+            entry = self.overruns.setdefault(name, {"count": 0})
+            entry.update({"count": entry["count"] + 1, "timeout": timeout,
+                          "last": datetime.utcnow().isoformat()})
+        for proc in children:
+            kill_process_group(proc)
+        print(f"[Agent] Collector '{name}' overran its {timeout}s deadline; killed {len(children)} child process(es).")
+
+    def run(self, name, fn, *args, timeout):
+        future = self.submit(name, fn, *args)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            self.overrun(name, timeout)
+            raise CollectorTimeout(name)
+
+    def run_many(self, jobs):
+        """Run {name: (fn, timeout)} concurrently. Returns results for the
+        collectors that finished in time; failures and overruns are left out."""
+        started = time.monotonic()
+        futures = {}
+        for name, (fn, timeout) in jobs.items():
+            try:
+                futures[name] = (self.submit(name, fn), timeout)
+            except CollectorBusy:
+                print(f"[Agent] Collector '{name}' is still running; skipped.")
+
+        results = {}
+        for name, (future, timeout) in futures.items():
+            remaining = max(0.0, started + timeout - time.monotonic())
+            try:
+                results[name] = future.result(timeout=remaining)
+            except FutureTimeout:
+                self.overrun(name, timeout)
+            except Exception as e:
+                print(f"[Agent] Collector '{name}' failed: {e}")
+        return results
+
+    def overrun_stats(self):
+        with self.lock:
+            return {name: dict(entry) for name, entry in self.overruns.items()}
+
+executor = CollectorExecutor()
+
+
+@profiled
 def get_static_inventory():
     return {
         "hostname": DEVICE_ID,
@@ -30,13 +565,11 @@ def get_static_inventory():
     }
 
 def get_usage_data():
-    cpu_percent = psutil.cpu_percent(interval=1)
-    mem = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
+    sample = sampler.latest()
     return {
-        "cpu_usage": f"{cpu_percent}%",
-        "ram_usage": f"{round(mem.used / (1024**3))} GB / {round(mem.total / (1024**3))} GB",
-        "disk_usage": f"{round(disk.used / (1024**3))} GB / {round(disk.total / (1024**3))} GB"
+        "cpu_usage": f"{sample['cpu']}%",
+        "ram_usage": f"{round(sample['ram_used'] / (1024**3))} GB / {round(sample['ram_total'] / (1024**3))} GB",
+        "disk_usage": f"{round(sample['disk_used'] / (1024**3))} GB / {round(sample['disk_total'] / (1024**3))} GB"
     }
 
 def get_local_ip():
@@ -67,21 +600,95 @@ def get_dmi_info(field):
 
 def get_gpu_info():
     try:
-        output = subprocess.check_output("lspci | grep -i vga", shell=True, text=True)
+        output = run_command("lspci | grep -i vga", shell=True, capture_output=True, text=True,
+                             timeout=10, check=True).stdout
         return output.strip()
     except:
         return "Unknown"
 
 def get_gnome_version():
     try:
-        output = subprocess.check_output("gnome-shell --version", shell=True, text=True)
+        output = run_command("gnome-shell --version", shell=True, capture_output=True, text=True,
+                             timeout=10, check=True).stdout
         return output.replace("GNOME Shell", "").strip()
     except:
         return "Unknown"
 
+# ---------------- STATIC INVENTORY CACHE ----------------
+# Static facts (DMI, OS, GPU, GNOME, IP, totals) are collected once and kept on
+# disk until the boot, kernel, os-release or network addresses change. The
+# cache key travels with every inventory post; the full body is only sent
+# when the server has not yet acknowledged the current key. The report and
+# inventory collectors can run at once, so the cache is only touched under
+# static_cache_lock and callers get a copy.
+
+static_cache = {}
+static_cache_lock = threading.Lock()
+
+def read_boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id", "r") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def network_fingerprint():
+    addrs = sorted(
+        f"{name}={addr.address}"
+        for name, entries in psutil.net_if_addrs().items()
+        for addr in entries
+        if addr.family in (socket.AF_INET, socket.AF_INET6)
+    )
+    return hashlib.sha1("|".join(addrs).encode()).hexdigest()
+
+def static_cache_key():
+    try:
+        os_release = str(os.stat("/etc/os-release").st_mtime_ns)
+    except OSError:
+        os_release = ""
+    parts = [read_boot_id(), os.uname().release, os_release, network_fingerprint()]
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+
+def get_cached_static_inventory():
+    key = static_cache_key()
+    with static_cache_lock:
+        if static_cache.get("key") != key:
+            static_cache.clear()
+            static_cache.update(load_state("static_inventory") or {})
+        if static_cache.get("key") != key or not static_cache.get("facts"):
+            facts = get_static_inventory()
+            facts.pop("last_updated", None)
+            static_cache.update({"key": key, "facts": facts, "acked_key": static_cache.get("acked_key")})
+            save_state("static_inventory", dict(static_cache))
+        return dict(static_cache)
+
+@profiled
+def build_inventory_payload():
+    cache = get_cached_static_inventory()
+    usage = {**get_usage_data(), "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    if cache.get("acked_key") == cache["key"]:
+        return {"cache_key": cache["key"], "usage": usage}
+    return {"cache_key": cache["key"], "full": {**cache["facts"], **usage}}
+
+def finish_inventory_sync(status_code, payload):
+    """Remember the acknowledged key, or resend the full body if the server lost it."""
+    try:
+        if status_code == 409 and "full" not in payload:
+            cache = get_cached_static_inventory()
+            payload = {"cache_key": cache["key"], "full": {**cache["facts"], **payload["usage"]}}
+            status_code = http.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/inventory", json=payload).status_code
+        if status_code == 200:
+            with static_cache_lock:
+                if static_cache.get("acked_key") != payload["cache_key"]:
+                    static_cache["acked_key"] = payload["cache_key"]
+                    save_state("static_inventory", dict(static_cache))
+    except Exception as e:
+        print(f"[Agent] Failed to resend inventory: {e}")
+
 # ---------------- EXTENSIONS ----------------
 
 
+@profiled
 def collect_extensions():
     extensions_dir = os.path.expanduser("~/.vscode/extensions")
     try:
@@ -96,24 +703,7 @@ def collect_extensions():
     except:
         return []
 
-def fetch_whitelist():
-    try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/extension-policy")
-        if res.status_code == 200:
-            return res.json()
-    except:
-        pass
-    return {}
-
-def fetch_blacklist():
-    try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/extension-blacklist")
-        if res.status_code == 200:
-            return res.json().get("vscode", [])
-    except:
-        pass
-    return []
-
+@profiled
 def enforce_policy(installed, whitelist):
     allowed = [name.lower() for name in whitelist.get("vscode", [])]
     
@@ -122,7 +712,7 @@ def enforce_policy(installed, whitelist):
 
     for ext in installed:
         if ext.lower() not in allowed:
-            subprocess.run([
+            run_command([
                 'code',
                 '--no-sandbox',
                 f'--user-data-dir={user_data_dir}',
@@ -130,77 +720,162 @@ def enforce_policy(installed, whitelist):
                 ext
             ])
 
+@profiled
 def enforce_blacklist(installed, blacklist):
     for ext in installed:
         if ext.lower() in [b.lower() for b in blacklist]:
             ext_path = os.path.expanduser(f"~/.vscode/extensions/{ext}")
             if os.path.isdir(ext_path):
-                subprocess.run(['rm', '-rf', ext_path])
-
-def push_extensions(installed):
-    extensions = [{"name": ext, "type": "vscode"} for ext in installed]
-    try:
-        requests.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/extensions", json=extensions)
-    except:
-        pass
+                run_command(['rm', '-rf', ext_path])
 
-def handle_extensions():
+@profiled
+def handle_extensions(extensions):
     try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/extensions/pending-removal")
-        if res.status_code == 200:
-            extensions = res.json()
-            for ext in extensions:
-                ext_path = os.path.expanduser(f"~/.vscode/extensions/{ext}")
-                if os.path.isdir(ext_path):
-                    subprocess.run(['rm', '-rf', ext_path])
+        for ext in extensions:
+            ext_path = os.path.expanduser(f"~/.vscode/extensions/{ext}")
+            if os.path.isdir(ext_path):
+                run_command(['rm', '-rf', ext_path])
     except:
         pass
 
 # ---------------- SOFTWARE ----------------
 
-def get_installed_software():
+DPKG_STATUS = "/var/lib/dpkg/status"
+DPKG_FIELDS = ("Package", "Status", "Version", "Architecture", "Installed-Size")
+
+dpkg_cache = {"key": None, "software": []}
+
+def dpkg_package_entry(fields):
+    # Status is "<want> <flag> <state>", e.g. "install ok installed".
+    status = fields.get("Status", "").split()
+    state = status[2] if len(status) == 3 else "unknown"
+    name = fields.get("Package")
+    if not name or state == "not-installed":
+        return None
     try:
-        result = subprocess.run(['dpkg-query', '-W', '-f=${Package} ${Version}\n'], capture_output=True, text=True)
-        lines = result.stdout.strip().split('\n')
-        software = []
-        for line in lines:
-            parts = line.strip().split()
-            if len(parts) >= 2:
-                name, version = parts[0], parts[1]
-                software.append({
-                    "name": name,
-                    "version": version,
-                    "state": "installed",
-                    "path": f"/usr/bin/{name}",
-                    "type": "App"
-                })
-        return software
-    except:
-        return []
+        size_kb = int(fields.get("Installed-Size", ""))
+    except ValueError:
+        size_kb = None
+    return {
+        "name": name,
+        "version": fields.get("Version", ""),
+        "state": state,
+        "arch": fields.get("Architecture", ""),
+        "size_kb": size_kb,
+        "type": "App"
+    }
 
-def push_software(software_data):
+def parse_dpkg_status(path=None):
+    """Stream the dpkg status database (what dpkg-query reads) one stanza at a time."""
+    software = []
+    fields = {}
+    with open(path or DPKG_STATUS, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if line == "\n":
+                entry = dpkg_package_entry(fields) if fields else None
+                if entry:
+                    software.append(entry)
+                fields = {}
+            elif line[0] not in " \t":
+                key, sep, value = line.partition(":")
+                if sep and key in DPKG_FIELDS:
+                    fields[key] = value.strip()
+    entry = dpkg_package_entry(fields) if fields else None
+    if entry:
+        software.append(entry)
+    return software
+
+def dpkg_status_key():
     try:
-        requests.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/software", json=software_data)
-    except:
-        pass
+        st = os.stat(DPKG_STATUS)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
 
-def fetch_software_uninstall_list():
+@profiled
+def get_installed_software():
+    # Re-parse only when dpkg has written the status file; otherwise one stat().
+    key = dpkg_status_key()
+    if key is None:
+        return []
+    if dpkg_cache["key"] != key:
+        try:
+            dpkg_cache["software"] = parse_dpkg_status()
+            dpkg_cache["key"] = key
+        except OSError as e:
+            print(f"[Agent] Failed to read dpkg status: {e}")
+            return []
+    return list(dpkg_cache["software"])
+
+def item_digest(item):
+    return hashlib.sha1(json.dumps(item, sort_keys=True).encode()).hexdigest()
+
+def diff_software_snapshot(software_data, last_state):
+    # Key by name, matching how the backend stores software and processes.
+    current = {item["name"]: item for item in software_data if item.get("name")}
+    digests = {name: item_digest(item) for name, item in current.items()}
+    version = hashlib.sha1("".join(f"{n}:{digests[n]}\n" for n in sorted(digests)).encode()).hexdigest()
+
+    previous = (last_state or {}).get("items", {})
+    delta = {
+        "base": (last_state or {}).get("version"),
+        "version": version,
+        "added": [current[n] for n in digests if n not in previous],
+        "changed": [current[n] for n in digests if n in previous and previous[n] != digests[n]],
+        "removed": [n for n in previous if n not in digests],
+    }
+    return delta, {"version": version, "items": digests}, current
+
+# dpkg status key and version of the snapshot the server last acknowledged,
+# mirrored from the saved state so an unchanged status file costs one stat().
+software_acked = {"loaded": False, "key": None, "version": None}
+
+def remember_software_ack(state):
+    software_acked.update(loaded=True, key=(state or {}).get("dpkg_key"), version=(state or {}).get("version"))
+
+@profiled
+def build_software_delta(software_data, dpkg_key=None):
+    last_state = load_state("software_snapshot")
+    delta, new_state, current = diff_software_snapshot(software_data, last_state)
+    new_state["dpkg_key"] = dpkg_key
+    # An empty delta is still sent: it is tiny and lets the server flag a
+    # version mismatch (e.g. after a backend restart) so we can resync.
+    if not last_state:
+        delta = {"base": None, "version": delta["version"], "full": list(current.values())}
+    return delta, new_state, current
+
+def finish_software_sync(status_code, delta, new_state, current):
+    """Record the acknowledged snapshot, or resend it in full on a version mismatch."""
     try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/software/pending-removal")
-        if res.status_code == 200:
-            return res.json()
-    except:
-        pass
-    return []
+        if status_code == 409 and "full" not in delta:
+            print("[Agent] Software version mismatch, sending full snapshot.")
+            if current is None:
+                # The unchanged-file shortcut skipped reading packages; read them now.
+                key = dpkg_status_key()
+                _, new_state, current = diff_software_snapshot(get_installed_software(), None)
+                new_state["dpkg_key"] = key
+            res = http.post(
+                f"{SERVER_URL}/api/devices/{DEVICE_ID}/software/delta",
+                json={"base": None, "version": new_state["version"], "full": list(current.values())}
+            )
+            status_code = res.status_code
+        if status_code == 200:
+            if new_state is not None:
+                save_state("software_snapshot", new_state)
+                remember_software_ack(new_state)
+        else:
+            print(f"[Agent] Software sync rejected: {status_code}")
+    except Exception as e:
+        print(f"[Agent] Failed to resync software: {e}")
 
 def uninstall_software(name):
     try:
-        subprocess.run(["apt", "remove", "-y", name], capture_output=True, text=True)
+        run_command(["apt", "remove", "-y", name], capture_output=True, text=True, timeout=600)
     except:
         pass
 
-def enforce_software_uninstall():
-    targets = fetch_software_uninstall_list()
+@profiled
+def enforce_software_uninstall(targets):
     cleared = []
 
     for item in targets:
@@ -213,59 +888,170 @@ def enforce_software_uninstall():
             print(f"Uninstalling software: {name}")
             uninstall_software(name)
             cleared.append(name)
+    return cleared
 
-    # Remove completed uninstalls from pending_removals
-    try:
-        if cleared:
-            requests.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/software/remove-completed", json=cleared)
-    except:
-        pass
 
+# ---------------- PROCESS SNAPSHOT ----------------
+# Processes are reported separately from installed software. Each process is
+# read once per snapshot inside oneshot(), and CPU and IO are turned into
+# rates from the previous snapshot's counters. Only the top consumers are sent
+# in full; every other process appears only in a per-name summary.
 
-def get_running_processes():
-    processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'exe']):
-        try:
-            processes.append({
-                "name": proc.info['name'],
-                "pid": proc.info['pid'],
-                "path": proc.info['exe'] or "",
-                "state": "running",
-                "type": "process"
-            })
-        except (psutil.NoSuchProcess, psutil.AccessDenied):
-            continue
-    return processes
+PROCESS_TOP_N = 15
 
-def push_running_processes():
-    procs = get_running_processes()
-    try:
-        requests.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/software", json=procs)
-    except:
-        pass
+class ProcessSnapshotter:
+    def __init__(self, top_n=PROCESS_TOP_N):
+        self.top_n = top_n
+        self.lock = threading.Lock()
+        self.previous = {}       # pid -> (create_time, cpu seconds, read bytes, write bytes)
+        self.previous_time = None
+
+    def read(self, proc):
+        with proc.oneshot():
+            cpu = proc.cpu_times()
+            try:
+                io = proc.io_counters()
+                read_bytes, write_bytes = io.read_bytes, io.write_bytes
+            except (psutil.AccessDenied, AttributeError):
+                read_bytes = write_bytes = None
+            try:
+                exe = proc.exe()
+            except psutil.AccessDenied:
+                exe = ""
+            return {
+                "pid": proc.pid,
+                "name": proc.name(),
+                "exe": exe,
+                "user": proc.username(),
+                "create_time": proc.create_time(),
+                "threads": proc.num_threads(),
+                "rss": proc.memory_info().rss,
+                "cpu_seconds": cpu.user + cpu.system,
+                "read_bytes": read_bytes,
+                "write_bytes": write_bytes,
+            }
+
+    def snapshot(self):
+        with self.lock:
+            return self._snapshot()
 
+    def _snapshot(self):
+        now = time.monotonic()
+        elapsed = now - self.previous_time if self.previous_time else None
+        wall = time.time()
+        rows, current = [], {}
+        for proc in psutil.process_iter():
+            try:
+                row = self.read(proc)
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                continue
+            key = (row["create_time"], row["cpu_seconds"], row["read_bytes"], row["write_bytes"])
+            current[row["pid"]] = key
+            prev = self.previous.get(row["pid"])
+            if prev and prev[0] == row["create_time"] and elapsed:
+                window = elapsed
+            else:
+                # New since the last snapshot (or the first one): use lifetime averages.
+                window = max(1.0, wall - row["create_time"])
+                prev = (row["create_time"], 0.0, 0, 0)
+            row["cpu"] = round(max(0.0, row["cpu_seconds"] - prev[1]) / window * 100, 1)
+            for field, index in (("read_bps", 2), ("write_bps", 3)):
+                counter = row[field.replace("_bps", "_bytes")]
+                row[field] = int(max(0, counter - (prev[index] or 0)) / window) if counter is not None else None
+            rows.append(row)
+        self.previous = current
+        self.previous_time = now
+
+        names = {}
+        for row in rows:
+            entry = names.setdefault(row["name"], {"count": 0, "cpu": 0.0, "rss": 0})
+            entry["count"] += 1
+            entry["cpu"] = round(entry["cpu"] + row["cpu"], 1)
+            entry["rss"] += row["rss"]
+
+        top = {}
+        for sort_key in (lambda r: r["cpu"], lambda r: r["rss"], lambda r: (r["read_bps"] or 0) + (r["write_bps"] or 0)):
+            for row in sorted(rows, key=sort_key, reverse=True)[:self.top_n]:
+                top[row["pid"]] = {k: v for k, v in row.items() if k not in ("cpu_seconds", "read_bytes", "write_bytes")}
+        return {
+            "timestamp": datetime.utcnow().isoformat(),
+            "interval": round(elapsed, 1) if elapsed else None,
+            "total": len(rows),
+            "top": sorted(top.values(), key=lambda r: r["cpu"], reverse=True),
+            "names": names,
+        }
 
+process_snapshotter = ProcessSnapshotter()
+
+@profiled
+def get_process_snapshot():
+    return process_snapshotter.snapshot()
+
+
+SERVICE_PROPERTIES = "Id,Description,MainPID,UnitFileState,ActiveState,SubState"
+SERVICE_SHOW_CHUNK = 500
+
+def list_service_units():
+    result = run_command(['systemctl', 'list-units', '--type=service', '--no-pager', '--all', '--no-legend', '--plain'],
+                            capture_output=True, text=True)
+    units = []
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if parts and parts[0].endswith(".service"):
+            units.append(parts[0])
+    return units
+
+def show_service_units(units):
+    # One `systemctl show` per chunk of units instead of three calls per unit.
+    # Each unit comes back as a block of Key=Value lines separated by a blank line.
+    props = {}
+    for i in range(0, len(units), SERVICE_SHOW_CHUNK):
+        chunk = units[i:i + SERVICE_SHOW_CHUNK]
+        result = run_command(['systemctl', 'show', '--no-pager', f'--property={SERVICE_PROPERTIES}', *chunk],
+                                capture_output=True, text=True)
+        for block in result.stdout.split('\n\n'):
+            fields = {}
+            for line in block.splitlines():
+                key, sep, value = line.partition('=')
+                if sep:
+                    fields[key] = value
+            if fields.get("Id"):
+                props[fields["Id"]] = fields
+    return props
+
+def sample_process_usage(pids):
+    usage = {}
+    for pid, (cpu, rss) in sampler.process_usage(pids).items():
+        usage[pid] = (f"{cpu}%", f"{round(rss / 1024 / 1024)} MB")
+    return usage
+
+@profiled
 def get_services():
     services = []
     try:
-        result = subprocess.run(['systemctl', 'list-units', '--type=service', '--no-pager', '--all', '--no-legend'],
-                                capture_output=True, text=True)
-        lines = result.stdout.strip().split('\n')
-        for line in lines:
-            if not line.strip():
-                continue
-            parts = line.split()
-            name = parts[0]
-            status = parts[3] if len(parts) > 3 else "unknown"
-            pid = get_service_pid(name)
-            cpu, ram = get_resource_usage(pid) if pid else ("0%", "0 MB")
-            description = get_service_description(name)
-            startup = get_startup_type(name)
+        units = list_service_units()
+        props = show_service_units(units)
+
+        pids = {}
+        for name in units:
+            try:
+                pid = int(props.get(name, {}).get("MainPID", "0"))
+            except ValueError:
+                pid = 0
+            pids[name] = pid if pid > 0 else None
+
+        usage = sample_process_usage([pid for pid in pids.values() if pid])
+
+        for name in units:
+            unit = props.get(name, {})
+            pid = pids[name]
+            cpu, ram = usage.get(pid, ("0%", "0 MB"))
             services.append({
                 "name": name,
-                "description": description,
-                "status": status,
-                "startup": startup,
+                "description": unit.get("Description") or "N/A",
+                "status": unit.get("SubState") or "unknown",
+                "active": unit.get("ActiveState") or "unknown",
+                "startup": unit.get("UnitFileState") or "unknown",
                 "pid": pid,
                 "cpu": cpu,
                 "ram": ram
@@ -274,116 +1060,52 @@ def get_services():
         print(f"Error fetching services: {e}")
     return services
 
-def get_service_description(name):
-    try:
-        result = subprocess.run(['systemctl', 'show', name, '--property=Description'], capture_output=True, text=True)
-        return result.stdout.strip().split('=')[1]
-    except:
-        return "N/A"
-
-def get_startup_type(name):
-    try:
-        result = subprocess.run(['systemctl', 'is-enabled', name], capture_output=True, text=True)
-        return result.stdout.strip()
-    except:
-        return "unknown"
-
-def get_service_pid(name):
+@profiled
+def enforce_service_actions(actions):
+    completed = []
     try:
-        result = subprocess.run(['systemctl', 'show', name, '--property=MainPID'], capture_output=True, text=True)
-        pid_line = result.stdout.strip()
-        if '=' in pid_line:
-            pid = int(pid_line.split('=')[1])
-            return pid if pid > 0 else None
-    except:
-        return None
-
-def get_resource_usage(pid):
-    try:
-        p = psutil.Process(pid)
-        cpu = f"{p.cpu_percent(interval=0.1)}%"
-        ram = f"{round(p.memory_info().rss / 1024 / 1024)} MB"
-        return cpu, ram
-    except:
-        return "0%", "0 MB"
-
-def push_services():
-    services = get_services()
-    try:
-        requests.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/services", json=services)
-        print(" Services pushed.")
-    except Exception as e:
-        print(f" Failed to push services: {e}")
-
-def fetch_pending_service_actions():
-    try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/services/pending-actions")
-        if res.status_code == 200:
-            return res.json()
-    except:
-        pass
-    return []
-
-def enforce_service_actions():
-    try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/services/pending-actions")
-        if res.status_code == 200:
-            actions = res.json()
-            completed = []
-
-            for item in actions:
-                service = item.get("service")
-                action = item.get("action")
+        for item in actions:
+            # The same queue also carries plain strings such as "lock-user".
+            if not isinstance(item, dict):
+                continue
+            service = item.get("service")
+            action = item.get("action")
 
-                if not service or not action:
-                    continue
+            if not service or not action:
+                continue
 
-                print(f"⏳ Executing {action} on service {service}...")
+            print(f"⏳ Executing {action} on service {service}...")
 
-                try:
-                    if action == "start":
-                        subprocess.run(["systemctl", "start", service])
-                    elif action == "stop":
-                        subprocess.run(["systemctl", "stop", service])
-                    elif action == "restart":
-                        subprocess.run(["systemctl", "restart", service])
-                    elif action == "disable":
-                        subprocess.run(["systemctl", "disable", service])
-                    elif action == "delete":
-                        subprocess.run(["systemctl", "stop", service])
-                        subprocess.run(["systemctl", "disable", service])
-                        # DO NOT MASK OR DELETE unless absolutely required:
-                        # subprocess.run(["rm", f"/etc/systemd/system/{service}"])
-
-                    completed.append(item)
-
-                except Exception as e:
-                    print(f"⚠️ Failed to execute {action} on {service}: {e}")
-
-            # ✅ Report completed ones
-            if completed:
-                try:
-                    requests.post(
-                        f"{SERVER_URL}/api/devices/{DEVICE_ID}/services/clear-completed",
-                        json=completed
-                    )
-                except Exception as e:
-                    print("❌ Failed to report completed service actions:", e)
+            try:
+                if action == "start":
+                    run_command(["systemctl", "start", service])
+                elif action == "stop":
+                    run_command(["systemctl", "stop", service])
+                elif action == "restart":
+                    run_command(["systemctl", "restart", service])
+                elif action == "disable":
+                    run_command(["systemctl", "disable", service])
+                elif action == "delete":
+                    run_command(["systemctl", "stop", service])
+                    run_command(["systemctl", "disable", service])
+                    # DO NOT MASK OR DELETE unless absolutely required:
+                    # subprocess.run(["rm", f"/etc/systemd/system/{service}"])
+
+                completed.append(item)
+
+            except Exception as e:
+                print(f"⚠️ Failed to execute {action} on {service}: {e}")
     except Exception as e:
         print("❌ Failed to enforce service actions:", e)
+    return completed
       
 
-def fetch_pending_process_kills():
-    try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/processes/pending-kills")
-        if res.status_code == 200:
-            return res.json()
-    except:
-        pass
-    return []
-
-def enforce_process_kills():
-    targets = fetch_pending_kill_list()  # this gives list of dicts
+@profiled
+def enforce_process_kills(targets):
+    cleared = []
+    forever = set()
+    # One /proc scan serves every rule instead of one full scan per target.
+    index = build_process_index() if targets else {}
     for item in targets:
         if isinstance(item, dict):
             name = item.get("name")
@@ -393,155 +1115,243 @@ def enforce_process_kills():
 
         if not name:
             continue
+        if mode == "forever":
+            forever.add(name)
 
         print(f" Attempting to kill process: {name} [mode: {mode}]")
-        success = kill_process(name)
+        success = kill_process(name, index)
 
         if success and mode == "once":
-            clear_process_kill(DEVICE_ID, name)
-
-def clear_process_kill(device_id, name):
-    try:
-        res = requests.delete(f"{SERVER_URL}/api/devices/{device_id}/processes/pending-kill/{name}")
-        if res.status_code == 200:
-            print(f" Cleared '{name}' from kill queue (once mode).")
-    except Exception as e:
-        print(f" Failed to clear kill for {name}: {e}")
-
-
-def fetch_pending_kill_list():
-    try:
-        url = f"{SERVER_URL}/api/devices/{DEVICE_ID}/processes/pending-kill"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        print(f" Failed to fetch process kill list: {e}")
-        return []
+            cleared.append(name)
 
+    process_guard.set_rules(forever)
+    return cleared
 
-def notify_backend_of_kill(name):
-    try:
-        requests.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/processes/{name}/kill/complete")
-    except:
-        pass
+def build_process_index():
+    index = {}
+    for proc in psutil.process_iter(['pid', 'name']):
+        name = proc.info['name']
+        if name:
+            index.setdefault(name.lower(), []).append(proc.info['pid'])
+    return index
 
-def kill_process(name):
+def kill_process(name, index=None):
+    if index is None:
+        index = build_process_index()
     killed = []
-    for proc in psutil.process_iter(['pid', 'name']):
+    started = time.monotonic()
+    for pid in index.get(name.lower(), []):
         try:
-            if proc.info['name'].lower() == name.lower():
-                os.kill(proc.info['pid'], 9)  # SIGKILL
-                killed.append(proc.info['pid'])
+            os.kill(pid, 9)  # SIGKILL
+            killed.append(pid)
         except Exception as e:
-            print(f" Failed to kill process {proc.info['pid']}: {e}")
+            print(f" Failed to kill process {pid}: {e}")
     if killed:
         print(f" Killed process '{name}' -> PIDs: {killed}")
+        record_kills(name, len(killed), (time.monotonic() - started) * 1000)
         return True
     else:
         print(f" No running process named '{name}' found.")
         return False
 
-#---------------------SYSTEM ACTIONS----------------
-def check_and_execute_system_actions():
+# ---------------- PROCESS GUARD ----------------
+# "forever" kill rules are enforced continuously: new processes are detected
+# through the kernel proc connector (netlink, needs root) or, failing that, a
+# lightweight /proc scan, and killed as soon as their name matches a rule.
+
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+PROC_CN_MCAST_LISTEN = 1
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_COMM = 0x00000200
+PROC_SCAN_INTERVAL = 0.05
+COMM_LEN = 15            # kernel truncates comm to 15 characters
+
+kill_stats = {}
+kill_stats_lock = threading.Lock()
+
+def record_kills(name, count, latency_ms):
+    with kill_stats_lock:
+        entry = kill_stats.setdefault(name, {"kills": 0, "last_latency_ms": 0.0, "max_latency_ms": 0.0})
+        entry["kills"] += count
+        entry["last_latency_ms"] = round(latency_ms, 2)
+        entry["max_latency_ms"] = round(max(entry["max_latency_ms"], latency_ms), 2)
+
+def get_kill_stats():
+    with kill_stats_lock:
+        return {name: dict(entry) for name, entry in kill_stats.items()}
+
+def read_comm(pid):
     try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/actions/pending")
-        if res.status_code == 200:
-            actions = res.json()
-            if not actions:
-                return
-
-            for action in actions:
-                if action == 'shutdown':
-                    subprocess.run(['shutdown', '-h', 'now'])
-                elif action == 'restart':
-                    subprocess.run(['reboot'])
-
-            # After executing actions, clear them on the server
-            try:
-                requests.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/actions/clear")
-            except:
-                pass
-
-    except Exception as e:
-        print(f"Error executing system action: {e}")
-
-
-
-# ---------------- MAIN PUSH ----------------
+        with open(f"/proc/{pid}/comm", "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
 
-def push_data():
-    inventory = {
-        **get_static_inventory(),
-        **get_usage_data()
-    }
+def process_age_ms(pid):
+    # Field 22 of /proc/<pid>/stat is the start time in clock ticks since boot.
     try:
-        requests.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/inventory", json=inventory)
-    except:
-        pass
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return max(0.0, (time.clock_gettime(time.CLOCK_BOOTTIME) - started) * 1000)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+class ProcessGuard:
+    def __init__(self):
+        self.rules = {}                  # truncated comm -> rule name
+        self.lock = threading.Lock()
+        self.has_rules = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.mode = None
+
+    def set_rules(self, names):
+        with self.lock:
+            self.rules = {name.lower()[:COMM_LEN]: name for name in names}
+        if self.rules:
+            self.has_rules.set()
+        else:
+            self.has_rules.clear()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="process-guard", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.has_rules.set()
+
+    def check(self, pid, event_ns=None):
+        comm = read_comm(pid)
+        if not comm:
+            return
+        with self.lock:
+            rule = self.rules.get(comm.lower()[:COMM_LEN])
+        if rule is None:
+            return
+        try:
+            os.kill(pid, 9)
+        except OSError:
+            return
+        # Proc connector events are stamped with CLOCK_MONOTONIC nanoseconds.
+        if event_ns:
+            latency = (time.monotonic_ns() - event_ns) / 1e6
+        else:
+            latency = process_age_ms(pid)
+        record_kills(rule, 1, latency)
+        print(f" [guard] Killed '{rule}' pid {pid} after {latency:.1f} ms")
+
+    def _run(self):
+        try:
+            self._netlink_loop()
+        except OSError as e:
+            print(f"[Agent] Proc connector unavailable ({e}); falling back to /proc scan.")
+            self._proc_scan_loop()
 
-    installed = [ext["name"] for ext in collect_extensions()]
-    enforce_blacklist(installed, fetch_blacklist())
-    enforce_policy(installed, fetch_whitelist())
-    push_extensions(installed)
-    combined = get_installed_software() + get_running_processes()
-    push_software(combined)
+    def _netlink_loop(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        try:
+            sock.bind((0, CN_IDX_PROC))
+            # nlmsghdr + cn_msg + op
+            payload = struct.pack("=I", PROC_CN_MCAST_LISTEN)
+            cn_msg = struct.pack("=IIIIHH", CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(payload), 0) + payload
+            nl_msg = struct.pack("=IHHII", 16 + len(cn_msg), 3, 0, 0, os.getpid()) + cn_msg
+            sock.send(nl_msg)
+            sock.settimeout(1.0)
+            self.mode = "netlink"
+
+            while not self.stop_event.is_set():
+                try:
+                    data = sock.recv(4096)
+                except socket.timeout:
+                    continue
+                if len(data) < 60 or not self.has_rules.is_set():
+                    continue
+                what, _, event_ns = struct.unpack_from("=IIQ", data, 36)
+                if what in (PROC_EVENT_EXEC, PROC_EVENT_COMM):
+                    _, tgid = struct.unpack_from("=II", data, 52)
+                    self.check(tgid, event_ns)
+        finally:
+            sock.close()
+
+    def _proc_scan_loop(self):
+        self.mode = "proc-scan"
+        known = set()
+        while not self.stop_event.is_set():
+            if not self.has_rules.is_set():
+                known = set()
+                self.has_rules.wait(5)
+                continue
+            current = {int(e.name) for e in os.scandir("/proc") if e.name.isdigit()}
+            if known:
+                for pid in current - known:
+                    self.check(pid)
+            else:
+                for pid in current:
+                    self.check(pid)
+            known = current
+            self.stop_event.wait(PROC_SCAN_INTERVAL)
 
+process_guard = ProcessGuard()
 
-def fetch_service_removals():
+#---------------------SYSTEM ACTIONS----------------
+@profiled
+def check_and_execute_system_actions(actions):
     try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/services/pending-actions")
-        if res.status_code == 200:
-            return res.json()
-    except:
-        pass
-    return []
+        for action in actions:
+            if action == 'shutdown':
+                run_command(['shutdown', '-h', 'now'])
+            elif action == 'restart':
+                run_command(['reboot'])
+    except Exception as e:
+        print(f"Error executing system action: {e}")
 
+def is_patch_action(item):
+    if isinstance(item, dict):
+        return item.get("action") == "patch"
+    return item == "patch-system"
 
 def apply_patch_update():
     try:
-        update = subprocess.run(
+        update = run_command(
             ['sudo', 'apt', 'update', '-y'],
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             timeout=300
         )
-        upgrade = subprocess.run(
+        upgrade = run_command(
             ['sudo', 'apt', 'upgrade', '-y'],
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             timeout=600
         )
         combined_output = update.stdout.decode() + "\n" + upgrade.stdout.decode()
-
-        # Report result back
-        requests.post(
-            f"{SERVER_URL}/api/devices/{DEVICE_ID}/actions/patch-result",
-            json={
-                "output": combined_output,
-                "status": "success"
-            }
-        )
+        result = {
+            "output": combined_output,
+            "status": "success"
+        }
     except Exception as e:
-        requests.post(
-            f"{SERVER_URL}/api/devices/{DEVICE_ID}/actions/patch-result",
-            json={
-                "output": str(e),
-                "status": "failed"
-            }
-        )
+        result = {
+            "output": str(e),
+            "status": "failed"
+        }
 
-def handle_pending_actions():
-    try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/actions")
-        if res.status_code == 200:
-            actions = res.json()
+    # Reported through the patch_result ack
+    return result
 
-            for action_item in actions:
-                if isinstance(action_item, dict) and action_item.get("action") == "patch":
-                    apply_patch_update()
+@profiled
+def handle_pending_actions(actions):
+    try:
+        for action_item in actions:
+            if is_patch_action(action_item):
+                return apply_patch_update()
     except Exception as e:
         print(f"Error handling patch actions: {e}")
+    return None
 
 def lock_current_user():
     username = getpass.getuser()
@@ -549,11 +1359,11 @@ def lock_current_user():
         print(f"🔒 Locking user: {username}")
 
         # 1. Kill all user sessions
-        subprocess.run(["pkill", "-KILL", "-u", username], check=False)
+        run_command(["pkill", "-KILL", "-u", username], check=False)
         print(f"🔫 Logged out all sessions for '{username}'")
 
         # 2. Lock the account
-        subprocess.run(["usermod", "-L", username], check=True)
+        run_command(["usermod", "-L", username], check=True)
         print(f"🔐 Account for '{username}' has been locked.")
         
     except Exception as e:
@@ -562,56 +1372,49 @@ def lock_current_user():
 def unlock_current_user():
     username = getpass.getuser()
     try:
-        subprocess.run(["usermod", "-U", username], check=True)
+        run_command(["usermod", "-U", username], check=True)
         print(f"✅ User '{username}' unlocked.")
     except Exception as e:
         print(f"❌ Failed to unlock user '{username}':", e)
 
 
-def enforce_system_actions():
+@profiled
+def enforce_system_actions(actions):
+    handled = []
     try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/actions")
-        if res.status_code == 200:
-            actions = res.json()
-
-            if "lock-user" in actions:
-                lock_current_user()
+        if "lock-user" in actions:
+            lock_current_user()
+            handled.append("lock-user")
 
-            if "unlock-user" in actions:
-                unlock_current_user()
+        if "unlock-user" in actions:
+            unlock_current_user()
+            handled.append("unlock-user")
 
     except Exception as e:
         print("❌ Failed to enforce system actions:", e)
+    return handled
 
 #-------------------USB ACTION---------------
 
 
 def reload_usb_modules():
     try:
-        subprocess.run(['modprobe', '-r', 'usb_storage'], check=True)
-        subprocess.run(['modprobe', 'usb_storage'], check=True)
+        run_command(['modprobe', '-r', 'usb_storage'], check=True)
+        run_command(['modprobe', 'usb_storage'], check=True)
         print("🔁 USB kernel modules reloaded.")
     except Exception as e:
         print(f"❌ Failed to reload USB modules: {e}")
 
-def fetch_pending_usb_action():
-    try:
-        res = requests.get(f"{SERVER_URL}/api/devices/{DEVICE_ID}/action/usb-enable-pending")
-        if res.status_code == 200:
-            return res.json().get("enable_usb", False)
-    except:
-        pass
-    return False
-
 def notify_usb_enabled():
     try:
-        requests.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/action/usb-enabled")
+        http.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/action/usb-enabled")
     except:
         pass
 
-def enforce_usb_control():
+@profiled
+def enforce_usb_control(enable):
     try:
-        if fetch_pending_usb_action():
+        if enable:
             print("🔓 Enabling USB (temp)...")
             blacklist_path = "/etc/modprobe.d/blacklist.conf"
             line = "blacklist usb_storage\n"
@@ -635,35 +1438,750 @@ def enforce_usb_control():
     except Exception as e:
         print(f"❌ USB control error: {e}")
 
-def report_device():
+# End of the sample window the last report covered.
+report_window = {"until": 0.0}
+
+@profiled
+def build_report():
+    facts = get_cached_static_inventory()["facts"]
+    sample = sampler.latest()
+    report = {
+        "hostname": DEVICE_ID,
+        "os": facts["os"],
+        "ip": facts["ip"],
+        "status": "online",
+        "cpu": sample["cpu"],         # Float percentage
+        "ram": sample["ram"],         # Float percentage
+        "disk": sample["disk"],       # Float percentage
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    # Every tick since the previous report, so spikes between reports show up.
+    aggregates = sampler.aggregate(report_window["until"])
+    if aggregates:
+        report_window["until"] = aggregates.pop("until")
+        report["aggregates"] = aggregates
+    return report
+
+# ---------------- OFFLINE SPOOL ----------------
+# Reports that cannot be delivered are kept in a small SQLite file with their
+# original timestamps and replayed in batches once the backend is reachable.
+# Snapshots (inventory, services, software) are not spooled: the next cycle
+# re-collects them and only the latest one matters.
+
+SPOOL_MAX_ROWS = 50000
+SPOOL_MAX_AGE = 7 * 24 * 3600
+SPOOL_BATCH = 500
+
+class Spool:
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(STATE_DIR, "spool.db"), timeout=5)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, "
+            "created REAL NOT NULL, payload TEXT NOT NULL)"
+        )
+        return conn
+
+    def append(self, kind, payload):
+        try:
+            with self.lock, self._connect() as conn:
+                conn.execute("INSERT INTO spool (kind, created, payload) VALUES (?, ?, ?)",
+                             (kind, time.time(), json.dumps(payload)))
+                # Bounded: drop the oldest rows past the age and row limits.
+                conn.execute("DELETE FROM spool WHERE created < ?", (time.time() - SPOOL_MAX_AGE,))
+                conn.execute("DELETE FROM spool WHERE id <= (SELECT MAX(id) FROM spool) - ?", (SPOOL_MAX_ROWS,))
+        except sqlite3.Error as e:
+            print(f"[Agent] Failed to spool {kind}: {e}")
+
+    def peek(self, kind, limit=SPOOL_BATCH):
+        with self.lock, self._connect() as conn:
+            rows = conn.execute("SELECT id, payload FROM spool WHERE kind = ? ORDER BY id LIMIT ?",
+                                (kind, limit)).fetchall()
+        return [(row_id, json.loads(payload)) for row_id, payload in rows]
+
+    def remove(self, ids):
+        with self.lock, self._connect() as conn:
+            conn.executemany("DELETE FROM spool WHERE id = ?", [(i,) for i in ids])
+
+    def count(self, kind):
+        try:
+            with self.lock, self._connect() as conn:
+                return conn.execute("SELECT COUNT(*) FROM spool WHERE kind = ?", (kind,)).fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+spool = Spool()
+
+@profiled
+def replay_spool():
+    """Send spooled reports to the batch endpoint, oldest first, until empty
+    or the backend refuses. sent_at lets the backend correct for this clock's
+    skew; it de-duplicates on (hostname, timestamp)."""
+    if not spool.count("report"):
+        return
+    sent = 0
     try:
-        report = {
-            "hostname": DEVICE_ID,
-            "os": get_os_name(),
-            "ip": get_local_ip(),
-            "status": "online",
-            "cpu": psutil.cpu_percent(interval=1),         # Returns a float
-            "ram": psutil.virtual_memory().percent,         # Float percentage
-            "disk": psutil.disk_usage("/").percent          # Float percentage
-        }
-        res = requests.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/report", json=report)
-        print("[Agent] Sent device report:", res.status_code, res.text)
+        while True:
+            batch = spool.peek("report")
+            if not batch:
+                break
+            res = http.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/reports/batch",
+                            json={"sent_at": datetime.utcnow().isoformat(),
+                                  "reports": [payload for _, payload in batch]})
+            if res.status_code != 200:
+                print(f"[Agent] Spool replay rejected: {res.status_code}")
+                break
+            spool.remove([row_id for row_id, _ in batch])
+            sent += len(batch)
     except Exception as e:
-        print("[Agent] Error reporting device:", e)
+        print(f"[Agent] Spool replay failed: {e}")
+    if sent:
+        print(f"[Agent] Replayed {sent} spooled reports.")
+
+
+# ---------------- SYNC ----------------
+# One POST to /api/devices/<id>/sync per cycle carries the collected snapshots
+# and acks for commands run since the last sync; the response carries every
+# pending command and policy, so no per-command polling is needed.
+
+SYNC_SECTIONS = ("report", "inventory", "extensions", "services", "software", "processes")
+SCHEDULER = None
+sync_lock = threading.Lock()
+acks_lock = threading.Lock()
+
+def queue_acks(kind, items):
+    # Acks are persisted so they survive a crash or a reboot we triggered.
+    if not items:
+        return
+    with acks_lock:
+        acks = load_state("sync_acks", {})
+        if isinstance(items, list):
+            acks.setdefault(kind, []).extend(items)
+        else:
+            acks[kind] = items
+        save_state("sync_acks", acks)
+
+def clear_sent_acks(sent):
+    """Drop the acks the server has taken. Long-running commands queue theirs
+    from a worker thread, so acks queued after `sent` was read are kept."""
+    if not sent:
+        return
+    with acks_lock:
+        acks = load_state("sync_acks", {})
+        for kind, items in sent.items():
+            if isinstance(items, list) and isinstance(acks.get(kind), list):
+                rest = list(acks[kind])
+                for item in items:
+                    if item in rest:
+                        rest.remove(item)
+                acks[kind] = rest
+            elif acks.get(kind) == items:
+                acks[kind] = []
+            if not acks.get(kind):
+                acks.pop(kind, None)
+        save_state("sync_acks", acks)
+
+# Deadlines for each section when a one-shot run collects them in parallel.
+SECTION_TIMEOUTS = {"report": 15, "inventory": 60, "extensions": 30, "services": 90, "software": 120, "processes": 30}
+
+def collect_installed_extensions():
+    return [ext["name"] for ext in collect_extensions()]
+
+def collect_software_delta():
+    if not software_acked["loaded"]:
+        remember_software_ack(load_state("software_snapshot"))
+    key = dpkg_status_key()
+    if key is not None and key == software_acked["key"]:
+        # dpkg has not written since the server acknowledged this snapshot.
+        version = software_acked["version"]
+        return {"base": version, "version": version, "added": [], "changed": [], "removed": []}, None, None
+    return build_software_delta(get_installed_software(), key)
+
+SECTION_COLLECTORS = {
+    "report": build_report,
+    "inventory": build_inventory_payload,
+    "extensions": collect_installed_extensions,
+    "services": get_services,
+    "software": collect_software_delta,
+    "processes": get_process_snapshot,
+}
+
+def collect_sections(sections, parallel=False):
+    if parallel:
+        return executor.run_many({name: (SECTION_COLLECTORS[name], SECTION_TIMEOUTS[name]) for name in sections})
+    results = {}
+    for name in sections:
+        try:
+            results[name] = SECTION_COLLECTORS[name]()
+        except Exception as e:
+            print(f"[Agent] Collector '{name}' failed: {e}")
+    return results
+
+@profiled
+def sync_cycle(sections=SYNC_SECTIONS, dispatch=True, parallel=False, background=False):
+    # With dispatch=False the commands in the response are left to the command
+    # channel, which is then the only thread that executes commands and sends acks.
+    collected = collect_sections(sections, parallel)
+    installed = collected.get("extensions")
+    software = collected.get("software")
+    inventory = collected.get("inventory")
+
+    body = {
+        "transport": http.health(),
+        "kill_stats": get_kill_stats(),
+        "overruns": executor.overrun_stats(),
+        # The server leases commands to whoever fetches them; only ask when
+        # this cycle is going to run them.
+        "commands": dispatch,
+    }
+    if "report" in collected:
+        body["report"] = collected["report"]
+        body["profile"] = profiler.summary()
+        body["governor"] = governor.status()
+    if inventory:
+        body["inventory"] = inventory
+    if installed is not None:
+        body["extensions"] = [{"name": ext, "type": "vscode"} for ext in installed]
+    if "services" in collected:
+        body["services"] = collected["services"]
+    if software:
+        body["software"] = software[0]
+    if "processes" in collected:
+        body["processes"] = collected["processes"]
+
+    # Only the ack hand-off needs to be serialised; collection runs unlocked.
+    with sync_lock:
+        body["acks"] = load_state("sync_acks", {}) if dispatch else {}
+        try:
+            res = http.post(f"{SERVER_URL}/api/devices/{DEVICE_ID}/sync", json=body)
+        except Exception as e:
+            res = None
+            print(f"[Agent] Sync failed: {e}")
+        if res is None or res.status_code != 200:
+            if res is not None:
+                print(f"[Agent] Sync rejected: {res.status_code}")
+            if "report" in body and (res is None or res.status_code >= 500):
+                spool.append("report", body["report"])
+            return None
+        clear_sent_acks(body["acks"])
+
+    replay_spool()
+    response = res.json()
+    if response.get("report", {}).get("code") == 400:
+        # Resending would be rejected the same way, so it is not spooled
+        print(f"[Agent] Report rejected: {response['report'].get('error')}")
+    if inventory:
+        finish_inventory_sync(response.get("inventory", {}).get("code"), inventory)
+    if software:
+        finish_software_sync(response.get("software", {}).get("code"), *software)
+    apply_sync_response(response, installed, commands=dispatch, background=background)
+    return response
+
+def apply_sync_response(response, installed=None, commands=True, background=False):
+    # The server always sends its whole merged config, so an entry missing
+    # from it has been cleared and goes back to the default.
+    schedule = response.get("schedule")
+    if schedule is not None:
+        if SCHEDULER:
+            changed = SCHEDULER.retune(schedule)
+            if changed:
+                print(f"[Agent] Schedule updated: {', '.join(changed)}")
+        if governor.configure(schedule.get("governor")):
+            print(f"[Agent] Resource budget updated: {governor.budget}")
+
+    if installed is not None:
+        policy = response.get("extension_policy", {})
+        enforce_blacklist(installed, policy.get("blacklist", []))
+        enforce_policy(installed, policy.get("whitelist", {}))
+
+    if commands:
+        execute_commands(response, background)
+
+def ack_commands(response, kind, legacy_kind, done, key=None):
+    """Queue acks for the commands in `done`. Servers with a command queue send
+    ids alongside the legacy lists; those are acked by id, so a command queued
+    after this delivery is never cleared by running an identical one."""
+    if "commands" not in response:
+        queue_acks(legacy_kind, done)
+        return
+    done = done or []
+    queue_acks("ids", [
+        command["id"] for command in response["commands"]
+        if command.get("kind") == kind and (key(command["payload"]) if key else command["payload"]) in done
+    ])
+
+# Package removals and patching can take minutes. On the command channel they
+# run on the collector pool so kills, lock-user and USB commands keep arriving
+# within a second; their acks are queued when they finish and leave with the
+# next poll. A delivery that arrives while the previous one is still running
+# stays unacked and comes back when its lease expires.
+LONG_COMMANDS_JOB = "long_commands"
+
+def execute_commands(response, background=False):
+    removals = response.get("pending_removals", [])
+    handle_extensions(removals)
+    ack_commands(response, "service_action", "service_actions",
+                 enforce_service_actions(response.get("service_actions", [])))
+    ack_commands(response, "process_kill", "process_kills",
+                 enforce_process_kills(response.get("process_kills", [])),
+                 key=lambda payload: payload.get("name"))
+
+    # Ack before executing: shutdown and reboot may never return.
+    system_actions = response.get("system_actions", [])
+    ack_commands(response, "system_action", "system_actions", list(system_actions))
+    check_and_execute_system_actions(system_actions)
+
+    actions = response.get("actions", [])
+    ack_commands(response, "action", "actions", enforce_system_actions(actions))
+    enforce_usb_control(response.get("enable_usb", False))
+
+    if not removals and not any(is_patch_action(action) for action in actions):
+        return
+    if not background:
+        execute_long_commands(response)
+        return
+    try:
+        executor.submit(LONG_COMMANDS_JOB, execute_long_commands, response)
+    except CollectorBusy:
+        print("[Agent] Long-running commands still in progress; new ones wait for redelivery.")
+
+def execute_long_commands(response):
+    try:
+        ack_commands(response, "removal", "removals",
+                     enforce_software_uninstall(response.get("pending_removals", [])))
+        patch_result = handle_pending_actions(response.get("actions", []))
+        if patch_result:
+            queue_acks("patch_result", patch_result)
+    except Exception as e:
+        print(f"[Agent] Long-running commands failed: {e}")
+
+def sync_job(*sections):
+    def job():
+        sync_cycle(sections, dispatch=False)
+    job.__name__ = f"sync_{'_'.join(sections)}"
+    return job
+
+# ---------------- COMMAND CHANNEL ----------------
+# The daemon keeps one long-poll request open on /commands/wait. The server
+# answers as soon as a command is queued for this device, so actions arrive
+# within a second instead of on the next polling cycle.
+
+LONG_POLL_TIMEOUT = 25
+COMMAND_POLL_INTERVAL = 15   # fallback when the server has no wait endpoint
+
+def wait_for_commands(since):
+    body = {"since": since, "timeout": LONG_POLL_TIMEOUT, "acks": load_state("sync_acks", {})}
+    res = http.post(
+        f"{SERVER_URL}/api/devices/{DEVICE_ID}/commands/wait",
+        json=body,
+        timeout=(HTTP_TIMEOUT[0], LONG_POLL_TIMEOUT + 10),
+        retries=0
+    )
+    if res.status_code == 200:
+        clear_sent_acks(body["acks"])
+    return res
+
+def command_channel_loop(stop_event):
+    seq = None
+    failures = 0
+    while not stop_event.is_set():
+        try:
+            res = wait_for_commands(seq)
+        except Exception as e:
+            res = None
+            print(f"[Agent] Command channel error: {e}")
+
+        if res is not None and res.status_code == 404:
+            # Older backend: poll the sync endpoint instead.
+            sync_cycle((), background=True)
+            stop_event.wait(COMMAND_POLL_INTERVAL)
+            continue
+        if res is None or res.status_code != 200:
+            failures += 1
+            stop_event.wait(min(60, 2 ** failures))
+            continue
+
+        failures = 0
+        response = res.json()
+        seq = response.get("seq")
+        if "pending_removals" in response:
+            apply_sync_response(response, background=True)
+
+# ---------------- RESOURCE GOVERNOR ----------------
+# The agent runs at low CPU and IO priority, and so does everything it spawns
+# (systemctl, dpkg, apt inherit nice and ionice). The agent's own CPU and
+# memory are held to a budget, and the server can change it through the
+# "governor" entry of the agent config. When the agent is over budget or the
+# host is under pressure, the expensive collectors are stretched out. The
+# heartbeat and the command channel keep their normal rate.
+
+AGENT_NICE = 10
+GOVERNOR_INTERVAL = 5
+DEFAULT_BUDGET = {"cpu_percent": 5.0, "memory_mb": 200.0}
+EXPENSIVE_COLLECTORS = ("services", "software", "extensions")
+MAX_STRETCH = 8.0
+# Host pressure where stretching starts and where it reaches MAX_STRETCH. This
+# is PSI "some avg10" when the kernel exposes it, otherwise CPU percent.
+PRESSURE_LOW = 20.0
+PRESSURE_HIGH = 80.0
+
+def read_pressure(resource):
+    try:
+        with open(f"/proc/pressure/{resource}") as f:
+            for line in f:
+                if line.startswith("some "):
+                    return float(line.split()[1].split("=", 1)[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class Governor:
+    def __init__(self, budget=None):
+        # Environment settings replace the defaults; the server's entry goes on top.
+        self.base_budget = self.merged_budget(DEFAULT_BUDGET, {
+            "cpu_percent": os.environ.get("AGENT_CPU_BUDGET"),
+            "memory_mb": os.environ.get("AGENT_MEMORY_BUDGET_MB"),
+        })
+        self.budget = dict(self.base_budget)
+        self.process = psutil.Process()
+        self.lock = threading.Lock()
+        self.stretch = 1.0
+        self.state = {}
+        self.last_cpu = None
+        self.on_change = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.configure(budget)
+
+    @staticmethod
+    def merged_budget(base, overrides):
+        budget = dict(base)
+        for key, value in (overrides or {}).items():
+            if key not in DEFAULT_BUDGET or value is None:
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            if value > 0:
+                budget[key] = value
+        return budget
+
+    def configure(self, budget):
+        """Set the budget to the baseline plus `budget`, the server's whole
+        governor entry: keys it no longer sets return to the baseline."""
+        budget = self.merged_budget(self.base_budget, budget)
+        if budget == self.budget:
+            return False
+        self.budget = budget
+        if self.state.get("cgroup"):
+            self.apply_cgroup_limits()
+        return True
+
+    def lower_priority(self):
+        # nice and ionice are per-thread on Linux, so this runs before the
+        # daemon starts any threads and they all inherit it.
+        try:
+            if self.process.nice() < AGENT_NICE:
+                self.process.nice(AGENT_NICE)
+            self.state["nice"] = self.process.nice()
+        except (psutil.Error, OSError) as e:
+            print(f"[Agent] Could not lower CPU priority: {e}")
+        try:
+            self.process.ionice(psutil.IOPRIO_CLASS_BE, 7)
+            self.state["ionice"] = "best-effort/7"
+        except (AttributeError, psutil.Error, OSError, ValueError) as e:
+            print(f"[Agent] Could not lower IO priority: {e}")
+        self.apply_cgroup_limits()
+
+    def own_cgroup(self):
+        # Only a delegated cgroup v2 that holds nothing but the agent is
+        # touched; throttling a shared slice would throttle its neighbours.
+        try:
+            with open("/proc/self/cgroup") as f:
+                path = next(line.split("::", 1)[1].strip() for line in f if line.startswith("0::"))
+            cgroup = os.path.join("/sys/fs/cgroup", path.lstrip("/"))
+            with open(os.path.join(cgroup, "cgroup.procs")) as f:
+                procs = {int(pid) for pid in f.read().split()}
+        except (OSError, StopIteration, ValueError):
+            return None
+        if procs != {os.getpid()} or not os.access(os.path.join(cgroup, "cpu.max"), os.W_OK):
+            return None
+        return cgroup
+
+    def apply_cgroup_limits(self):
+        cgroup = self.own_cgroup()
+        if not cgroup:
+            return
+        period = 100000
+        quota = max(1000, int(period * self.budget["cpu_percent"] / 100))
+        try:
+            with open(os.path.join(cgroup, "cpu.max"), "w") as f:
+                f.write(f"{quota} {period}")
+            with open(os.path.join(cgroup, "memory.high"), "w") as f:
+                f.write(str(int(self.budget["memory_mb"] * 1024 ** 2)))
+            self.state["cgroup"] = cgroup
+        except OSError as e:
+            print(f"[Agent] Could not apply cgroup limits: {e}")
+
+    def agent_cpu_percent(self):
+        # Includes reaped children, so systemctl and dpkg count against the budget.
+        times = self.process.cpu_times()
+        total = times.user + times.system + times.children_user + times.children_system
+        now = time.monotonic()
+        last, self.last_cpu = self.last_cpu, (now, total)
+        if last is None or now <= last[0]:
+            return 0.0
+        return max(0.0, (total - last[1]) / (now - last[0]) * 100)
+
+    def host_pressure(self):
+        psi = [p for p in (read_pressure("cpu"), read_pressure("io")) if p is not None]
+        if psi:
+            return max(psi), "psi"
+        return sampler.latest_sample.get("cpu", 0.0), "cpu"
+
+    def shed_memory(self):
+        dpkg_cache["key"] = None
+        dpkg_cache["software"] = []
+        gc.collect()
+
+    def tick(self):
+        cpu = self.agent_cpu_percent()
+        rss_mb = self.process.memory_info().rss / (1024 ** 2)
+        pressure, source = self.host_pressure()
+
+        stretch = 1.0
+        if pressure > PRESSURE_LOW:
+            ratio = min(1.0, (pressure - PRESSURE_LOW) / (PRESSURE_HIGH - PRESSURE_LOW))
+            stretch = 1.0 + (MAX_STRETCH - 1.0) * ratio
+        if cpu > self.budget["cpu_percent"]:
+            stretch = max(stretch, cpu / self.budget["cpu_percent"])
+        if rss_mb > self.budget["memory_mb"]:
+            self.shed_memory()
+            rss_mb = self.process.memory_info().rss / (1024 ** 2)
+            if rss_mb > self.budget["memory_mb"]:
+                stretch = MAX_STRETCH
+        # Half steps keep small wobbles from rescheduling the collectors.
+        stretch = min(MAX_STRETCH, round(stretch * 2) / 2)
+
+        with self.lock:
+            changed = stretch != self.stretch
+            self.stretch = stretch
+            self.state.update({
+                "agent_cpu_percent": round(cpu, 1),
+                "agent_rss_mb": round(rss_mb, 1),
+                "pressure": round(pressure, 1),
+                "pressure_source": source,
+                "stretch": stretch,
+            })
+        if changed:
+            print(f"[Agent] Governor: expensive collectors at {stretch}x their interval "
+                  f"(pressure {pressure:.0f} {source}, agent cpu {cpu:.1f}%, rss {rss_mb:.0f} MB)")
+            if self.on_change:
+                self.on_change(EXPENSIVE_COLLECTORS)
+
+    def interval_factor(self, name):
+        return self.stretch if name in EXPENSIVE_COLLECTORS else 1.0
+
+    def status(self):
+        with self.lock:
+            return {**self.state, "budget": dict(self.budget)}
+
+    def _run(self):
+        self.agent_cpu_percent()
+        while not self.stop_event.wait(GOVERNOR_INTERVAL):
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"[Agent] Governor tick failed: {e}")
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="governor", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+governor = Governor()
+
+# ---------------- DAEMON ----------------
+
+# Seconds between runs and +/- random jitter per collector. The server can
+# override any of these through /api/devices/<id>/agent-config; the current
+# schedule comes back with every sync response.
+DEFAULT_SCHEDULE = {
+    "metrics":    {"interval": 60,   "jitter": 5},
+    "inventory":  {"interval": 3600, "jitter": 300},
+    "software":   {"interval": 1800, "jitter": 300},
+    "services":   {"interval": 300,  "jitter": 30},
+    "extensions": {"interval": 600,  "jitter": 60},
+    "processes":  {"interval": 60,   "jitter": 5},
+}
+MIN_INTERVAL = 5
+
+# Deadline per scheduled run, covering collection, the sync post and any
+# enforcement triggered by the response (extension uninstalls can be slow).
+COLLECTOR_TIMEOUTS = {
+    "metrics": 30,
+    "inventory": 90,
+    "software": 180,
+    "services": 120,
+    "extensions": 600,
+    "processes": 30,
+}
+
+COLLECTORS = {
+    "metrics": [sync_job("report")],
+    "inventory": [sync_job("inventory")],
+    "software": [sync_job("software")],
+    "services": [sync_job("services")],
+    "extensions": [sync_job("extensions")],
+    "processes": [sync_job("processes")],
+}
+
+class Scheduler:
+    """Runs each collector on its own thread, interval and jitter, so a slow
+    collector never delays a fast one."""
+
+    def __init__(self, collectors, schedule=None):
+        self.collectors = dict(collectors)
+        self.schedule = {name: dict(cfg) for name, cfg in DEFAULT_SCHEDULE.items()}
+        self.stop_event = threading.Event()
+        self.wakeups = {name: threading.Event() for name in self.collectors}
+        self.threads = []
+        if schedule:
+            self.retune(schedule)
+
+    def get_timing(self, name):
+        cfg = self.schedule.get(name) or DEFAULT_SCHEDULE.get(name) or {"interval": 60, "jitter": 0}
+        factor = governor.interval_factor(name)
+        return cfg["interval"] * factor, cfg.get("jitter", 0) * factor
+
+    def wake(self, names):
+        for name in names:
+            if name in self.wakeups:
+                self.wakeups[name].set()
+
+    def retune(self, schedule):
+        """Rebuild every collector's timing from DEFAULT_SCHEDULE plus the
+        server's schedule, so an override cleared on the server is dropped."""
+        changed = []
+        for name, default in DEFAULT_SCHEDULE.items():
+            current = dict(default)
+            cfg = (schedule or {}).get(name)
+            if isinstance(cfg, dict):
+                try:
+                    if "interval" in cfg:
+                        current["interval"] = max(MIN_INTERVAL, float(cfg["interval"]))
+                    if "jitter" in cfg:
+                        current["jitter"] = max(0.0, float(cfg["jitter"]))
+                except (TypeError, ValueError):
+                    current = dict(default)
+            if current != self.schedule[name]:
+                self.schedule[name] = current
+                changed.append(name)
+        # Wake sleeping collectors so a new interval applies to the current wait.
+        self.wake(changed)
+        return changed
+
+    def run_collector(self, name):
+        timeout = COLLECTOR_TIMEOUTS.get(name, COMMAND_TIMEOUT)
+        for job in self.collectors[name]:
+            try:
+                executor.run(name, job, timeout=timeout)
+            except CollectorBusy:
+                print(f"[Agent] Collector '{name}' is still running from its last run; skipped.")
+            except CollectorTimeout:
+                pass
+            except Exception as e:
+                print(f"[Agent] Collector '{name}' failed in {job.__name__}: {e}")
+
+    def _loop(self, name):
+        # Stagger the first run so a fleet of agents started together spreads out.
+        _, jitter = self.get_timing(name)
+        if self.stop_event.wait(random.uniform(0, jitter)):
+            return
+
+        wakeup = self.wakeups[name]
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            self.run_collector(name)
+
+            while not self.stop_event.is_set():
+                interval, jitter = self.get_timing(name)
+                delay = interval + random.uniform(-jitter, jitter)
+                remaining = started + delay - time.monotonic()
+                if remaining <= 0:
+                    break
+                if wakeup.wait(remaining):
+                    wakeup.clear()
+                    continue
+                break
+
+    def start(self):
+        for name in self.collectors:
+            t = threading.Thread(target=self._loop, args=(name,), name=f"collector-{name}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.stop_event.set()
+        for wakeup in self.wakeups.values():
+            wakeup.set()
+
+def run_daemon():
+    global SCHEDULER
+    scheduler = Scheduler(COLLECTORS)
+    SCHEDULER = scheduler
+
+    def handle_signal(signum, frame):
+        print(f"[Agent] Received signal {signum}, stopping.")
+        scheduler.stop()
+        governor.stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    print(f"[Agent] Daemon started for {DEVICE_ID} -> {SERVER_URL}")
+    governor.lower_priority()
+    governor.on_change = scheduler.wake
+    sampler.start()
+    governor.start()
+    process_guard.start()
+    scheduler.start()
+    threading.Thread(target=command_channel_loop, args=(scheduler.stop_event,),
+                     name="command-channel", daemon=True).start()
+    while not scheduler.stop_event.is_set():
+        scheduler.stop_event.wait(1)
+
+def run_once():
+    governor.lower_priority()
+    # The heartbeat is posted on its own as soon as it is collected, without
+    # taking commands; the other sections, which can take minutes, are
+    # collected meanwhile and sent with the command fetch in a second sync.
+    rest = tuple(name for name in SYNC_SECTIONS if name != "report")
+    others = threading.Thread(target=sync_cycle, args=(rest,), kwargs={"parallel": True}, name="sync-sections")
+    others.start()
+    sync_cycle(("report",), dispatch=False, parallel=True)
+    others.join()
+    # Flush acks for anything executed this run rather than waiting for cron.
+    if load_state("sync_acks"):
+        sync_cycle(())
 
 
 # ---------------- RUN ----------------
 
 if __name__ == "__main__":
-    push_data()
-    handle_extensions()
-    enforce_software_uninstall()
-    push_services()
-    enforce_service_actions()
-    enforce_process_kills()
-    check_and_execute_system_actions()
-    enforce_service_actions() 
-    handle_pending_actions()
-    enforce_system_actions()
-    enforce_usb_control()
-    report_device()
+    parser = argparse.ArgumentParser(description="System monitoring agent")
+    parser.add_argument("--daemon", action="store_true", help="run continuously with per-collector schedules")
+    args = parser.parse_args()
+
+    if args.daemon:
+        run_daemon()
+    else:
+        run_once()
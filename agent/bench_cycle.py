@@ -0,0 +1,440 @@
+"""Benchmark full agent sync cycles against fixture hosts of a chosen size.
+
+Usage: python bench_cycle.py [--units 500] [--packages 5000] [--processes 1000]
+                             [--extensions 40] [--cycles 5] [--exec-latency 5]
+                             [--save FILE] [--baseline FILE] [--tolerance 0.25]
+
+Nothing on the real host is read or changed. The harness swaps in:
+  * subprocess: systemctl list-units/show, lspci, gnome-shell, code and apt
+    answer from generated fixtures in their real output formats. Each call
+    sleeps --exec-latency ms to stand in for fork/exec.
+  * psutil: process_iter() and Process() see --processes fake processes,
+    whose CPU and IO counters move between reads.
+  * dpkg: a synthetic status file with --packages entries (see bench_dpkg).
+  * the backend: a local HTTP server that accepts every agent route. It
+    decodes gzip/zstd/msgpack like the real one and counts bytes per route.
+
+It runs --cycles full sync_cycle() calls. The first one is cold: the static
+inventory, dpkg cache and sampler are not primed yet. It then prints cold and
+warm (median) cycle times, per-collector wall time from the agent's own
+profiler, subprocesses per command and bytes per route.
+
+--save writes the results as JSON. --baseline compares against such a file
+and exits 1 when the warm cycle or any collector is more than --tolerance
+slower, or when the cycle spawns more subprocesses or sends more than
+--tolerance extra bytes.
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psutil
+
+import agent
+import bench_dpkg
+
+UNIT_STATES = [("running", "active", "enabled"), ("exited", "active", "static"),
+               ("dead", "inactive", "disabled"), ("failed", "failed", "enabled")]
+
+
+# ---------------- FIXTURES ----------------
+
+class Fixtures:
+    def __init__(self, root, units, packages, processes, extensions):
+        self.units = [f"bench-unit-{i:04d}.service" for i in range(units)]
+        self.processes = {1000 + i: FakeProcessState(1000 + i, i) for i in range(processes)}
+
+        admindir = os.path.join(root, "dpkg")
+        os.makedirs(admindir)
+        bench_dpkg.write_status(admindir, packages)
+        self.dpkg_status = os.path.join(admindir, "status")
+
+        self.home = os.path.join(root, "home")
+        self.extensions = [f"publisher.ext-{i:03d}-1.0.{i}" for i in range(extensions)]
+        for name in self.extensions:
+            os.makedirs(os.path.join(self.home, ".vscode", "extensions", name))
+
+    def unit_state(self, name):
+        i = int(name.split("-")[2].split(".")[0])
+        status, active, startup = UNIT_STATES[i % len(UNIT_STATES)]
+        pid = 1000 + i % max(1, len(self.processes)) if status == "running" else 0
+        return i, status, active, startup, pid
+
+    def list_units(self):
+        lines = []
+        for name in self.units:
+            _, status, active, _, _ = self.unit_state(name)
+            lines.append(f"{name} loaded {active} {status} Synthetic unit {name}")
+        return "\n".join(lines) + "\n"
+
+    def show_units(self, names):
+        blocks = []
+        for name in names:
+            i, status, active, startup, pid = self.unit_state(name)
+            blocks.append("\n".join([
+                f"Id={name}",
+                f"Description=Synthetic service number {i} used for cycle benchmarks",
+                f"MainPID={pid}",
+                f"UnitFileState={startup}",
+                f"ActiveState={active}",
+                f"SubState={status}",
+            ]))
+        return "\n\n".join(blocks) + "\n"
+
+    def output(self, argv):
+        command = os.path.basename(argv[0])
+        if command == "systemctl" and "list-units" in argv:
+            return self.list_units()
+        if command == "systemctl" and "show" in argv:
+            return self.show_units([a for a in argv if a.endswith(".service")])
+        if command == "lspci":
+            return "00:02.0 VGA compatible controller: Intel Corporation UHD Graphics 620 (rev 07)\n"
+        if command == "gnome-shell":
+            return "GNOME Shell 42.9\n"
+        if command == "code":
+            return "".join(f"publisher.ext-{i:03d}\n" for i in range(20))
+        if command == "apt":
+            return "Reading package lists... Done\n0 upgraded, 0 newly installed, 0 to remove.\n"
+        return ""
+
+
+# ---------------- FAKE SUBPROCESS ----------------
+
+class FakeSubprocess(types.ModuleType):
+    """Stands in for the subprocess module inside agent.py only."""
+
+    def __init__(self, fixtures, latency):
+        super().__init__("subprocess")
+        self.fixtures = fixtures
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = {}
+        harness = self
+
+        class Popen:
+            def __init__(self, args, stdout=None, stderr=None, text=False, shell=False, **kwargs):
+                self.args = args
+                self.pid = -1
+                self.returncode = None
+                self.text = text or kwargs.get("universal_newlines", False)
+                self.capture = stdout is not None
+                argv = args.split() if shell else list(args)
+                self.argv = argv[:argv.index("|")] if "|" in argv else argv
+                with harness.lock:
+                    command = os.path.basename(self.argv[0])
+                    harness.calls[command] = harness.calls.get(command, 0) + 1
+
+            def communicate(self, timeout=None):
+                time.sleep(harness.latency)
+                out = harness.fixtures.output(self.argv)
+                self.returncode = 0
+                if not self.capture:
+                    return None, None
+                return (out, "") if self.text else (out.encode(), b"")
+
+            def poll(self):
+                return self.returncode
+
+            def wait(self, timeout=None):
+                return self.returncode
+
+            def kill(self):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+        self.Popen = Popen
+
+    def __getattr__(self, name):
+        return getattr(subprocess, name)
+
+
+# ---------------- FAKE PSUTIL ----------------
+
+class FakeProcessState:
+    def __init__(self, pid, i):
+        self.pid = pid
+        self.name = f"proc-{i % 200:03d}"
+        self.create_time = time.time() - 3600 - i
+        self.cpu = 0.5 + (i % 50) / 10
+        self.rss = (20 + i % 400) * 1024 * 1024
+        self.io = [i * 4096, i * 1024]
+        self.busy = (i % 37) / 1000    # CPU seconds gained per read
+
+    def tick(self):
+        self.cpu += self.busy
+        self.io[0] += self.pid % 7 * 4096
+        self.io[1] += self.pid % 5 * 1024
+
+
+class FakeProcess:
+    def __init__(self, state):
+        self.state = state
+        self.pid = state.pid
+        self.info = {}
+
+    @contextmanager
+    def oneshot(self):
+        self.state.tick()
+        yield
+
+    def name(self):
+        return self.state.name
+
+    def exe(self):
+        return f"/usr/bin/{self.state.name}"
+
+    def username(self):
+        return "bench"
+
+    def create_time(self):
+        return self.state.create_time
+
+    def num_threads(self):
+        return 1 + self.pid % 8
+
+    def memory_info(self):
+        return types.SimpleNamespace(rss=self.state.rss, vms=self.state.rss * 4)
+
+    def cpu_times(self):
+        return types.SimpleNamespace(user=self.state.cpu * 0.8, system=self.state.cpu * 0.2,
+                                     children_user=0.0, children_system=0.0)
+
+    def cpu_percent(self, interval=None):
+        return round(self.state.busy * 100, 1)
+
+    def io_counters(self):
+        return types.SimpleNamespace(read_bytes=self.state.io[0], write_bytes=self.state.io[1])
+
+
+class FakePsutil(types.ModuleType):
+    """Stands in for psutil inside agent.py; system-wide calls stay real."""
+
+    def __init__(self, fixtures):
+        super().__init__("psutil")
+        self.fixtures = fixtures
+
+    def Process(self, pid=None):
+        if pid is None:
+            return psutil.Process()
+        state = self.fixtures.processes.get(pid)
+        if state is None:
+            raise psutil.NoSuchProcess(pid)
+        return FakeProcess(state)
+
+    def process_iter(self, attrs=None):
+        for state in list(self.fixtures.processes.values()):
+            proc = FakeProcess(state)
+            if attrs:
+                proc.info = {attr: (proc.pid if attr == "pid" else getattr(proc, attr)()) for attr in attrs}
+            yield proc
+
+    def __getattr__(self, name):
+        return getattr(psutil, name)
+
+
+# ---------------- STAND-IN BACKEND ----------------
+
+class StandInBackend:
+    def __init__(self, fixtures):
+        self.lock = threading.Lock()
+        self.bytes = {}
+        self.requests = {}
+        backend = self
+        encodings = [name for name, module in (("msgpack", agent.msgpack), ("zstd", agent.zstandard))
+                     if module is not None] + ["gzip"]
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.reply({})
+
+            def do_DELETE(self):
+                self.reply({})
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                route = self.path.split(f"/api/devices/{agent.DEVICE_ID}/", 1)[-1]
+                with backend.lock:
+                    backend.bytes[route] = backend.bytes.get(route, 0) + len(raw)
+                    backend.requests[route] = backend.requests.get(route, 0) + 1
+                body = backend.decode(raw, self.headers)
+                response = {}
+                if route == "sync":
+                    # A compliant host: every installed extension is whitelisted.
+                    response["extension_policy"] = {"whitelist": {"vscode": fixtures.extensions}, "blacklist": []}
+                    for section in ("inventory", "software"):
+                        if body.get(section):
+                            response[section] = {"status": "ok", "code": 200}
+                elif route == "reports/batch":
+                    response = {"received": len(body.get("reports", [])), "inserted": len(body.get("reports", []))}
+                self.reply(response)
+
+            def reply(self, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("X-Accept-Body", ", ".join(encodings))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def decode(self, raw, headers):
+        encoding = headers.get("Content-Encoding")
+        if encoding == "gzip":
+            raw = gzip.decompress(raw)
+        elif encoding == "zstd":
+            raw = agent.zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+        if headers.get("Content-Type") == agent.MSGPACK_MIMETYPE:
+            return agent.msgpack.unpackb(raw, raw=False, strict_map_key=False)
+        return json.loads(raw) if raw else {}
+
+    def reset(self):
+        with self.lock:
+            self.bytes.clear()
+            self.requests.clear()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+# ---------------- RUN ----------------
+
+def run_cycles(args, fake_subprocess, backend):
+    cycles = []
+    for n in range(args.cycles):
+        agent.profiler.samples.clear()
+        backend.reset()
+        with fake_subprocess.lock:
+            fake_subprocess.calls.clear()
+        started = time.perf_counter()
+        agent.sync_cycle(parallel=args.parallel)
+        wall_ms = (time.perf_counter() - started) * 1000
+        summary = agent.profiler.summary()["collectors"]
+        cycles.append({
+            "wall_ms": round(wall_ms, 2),
+            "collectors": {name: entry["wall_ms"]["max"] for name, entry in summary.items()
+                           if not name.startswith("http ")},
+            "subprocesses": dict(fake_subprocess.calls),
+            "bytes": dict(backend.bytes),
+        })
+    return cycles
+
+
+def summarise(args, cycles):
+    warm = cycles[1:] or cycles
+    collectors = sorted({name for cycle in warm for name in cycle["collectors"]})
+    return {
+        "fixtures": {"units": args.units, "packages": args.packages,
+                     "processes": args.processes, "extensions": args.extensions},
+        "cold_ms": cycles[0]["wall_ms"],
+        "warm_ms": round(statistics.median(c["wall_ms"] for c in warm), 2),
+        "collectors_ms": {name: round(statistics.median(c["collectors"].get(name, 0.0) for c in warm), 2)
+                          for name in collectors},
+        "cold_collectors_ms": cycles[0]["collectors"],
+        "subprocesses": warm[-1]["subprocesses"],
+        "bytes": warm[-1]["bytes"],
+        "cold_bytes": cycles[0]["bytes"],
+    }
+
+
+def print_results(results):
+    print(f"fixtures: {results['fixtures']}")
+    print(f"cycle: cold {results['cold_ms']:.1f} ms, warm {results['warm_ms']:.1f} ms (median)")
+    print("collectors (warm median / cold):")
+    for name, ms in sorted(results["collectors_ms"].items(), key=lambda kv: -kv[1]):
+        print(f"  {name:<34} {ms:10.2f} ms {results['cold_collectors_ms'].get(name, 0.0):10.2f} ms")
+    print(f"subprocesses per warm cycle: {sum(results['subprocesses'].values())} {results['subprocesses']}")
+    print(f"bytes per cycle: warm {sum(results['bytes'].values())} {results['bytes']}, "
+          f"cold {sum(results['cold_bytes'].values())}")
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+
+    def check(label, current, previous):
+        if previous and current > previous * (1 + tolerance):
+            found.append(f"{label}: {previous} -> {current}")
+
+    check("warm cycle ms", results["warm_ms"], baseline.get("warm_ms"))
+    for name, ms in results["collectors_ms"].items():
+        # Sub-millisecond collectors are all noise.
+        if ms >= 1.0:
+            check(f"{name} ms", ms, baseline.get("collectors_ms", {}).get(name))
+    if sum(results["subprocesses"].values()) > sum(baseline.get("subprocesses", {}).values()):
+        found.append(f"subprocesses: {baseline.get('subprocesses')} -> {results['subprocesses']}")
+    check("bytes per warm cycle", sum(results["bytes"].values()), sum(baseline.get("bytes", {}).values()))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--units", type=int, default=500)
+    parser.add_argument("--packages", type=int, default=5000)
+    parser.add_argument("--processes", type=int, default=1000)
+    parser.add_argument("--extensions", type=int, default=40)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--exec-latency", type=float, default=5.0, help="ms per fake subprocess")
+    parser.add_argument("--parallel", action="store_true", help="collect sections in parallel like run_once()")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved earlier with --save")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench-cycle-")
+    backend = None
+    try:
+        fixtures = Fixtures(root, args.units, args.packages, args.processes, args.extensions)
+        fake_subprocess = FakeSubprocess(fixtures, args.exec_latency / 1000)
+        backend = StandInBackend(fixtures)
+
+        os.environ["HOME"] = fixtures.home
+        agent.STATE_DIR = os.path.join(root, "state")
+        agent.DPKG_STATUS = fixtures.dpkg_status
+        agent.SERVER_URL = backend.url
+        agent.subprocess = fake_subprocess
+        agent.psutil = FakePsutil(fixtures)
+
+        results = summarise(args, run_cycles(args, fake_subprocess, backend))
+        print_results(results)
+    finally:
+        if backend:
+            backend.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+        print(f"no regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
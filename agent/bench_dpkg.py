@@ -0,0 +1,113 @@
+"""Benchmark the native dpkg status parser against the old dpkg-query path.
+
+Usage: python bench_dpkg.py [--packages 5000] [--rounds 5]
+
+Generates a synthetic dpkg status database of the requested size in a
+temporary admin dir, then times:
+  * dpkg-query -W (the subprocess path get_installed_software() used to take)
+  * parse_dpkg_status() on the same file
+  * get_installed_software() when the file is unchanged (cache hit: one stat)
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+import agent
+
+STANZA = """Package: {name}
+Status: install ok installed
+Priority: optional
+Section: libs
+Installed-Size: {size}
+Maintainer: Bench Maintainers <bench@example.org>
+Architecture: amd64
+Multi-Arch: same
+Source: {name}-src
+Version: {major}.{minor}.{patch}-{rev}ubuntu1
+Depends: libc6 (>= 2.34), libgcc-s1 (>= 3.0), zlib1g (>= 1:1.2.0)
+Description: synthetic package {name} for benchmarking
+ This is a long description line that dpkg keeps in the status file
+ and that the parser has to skip over without storing anything.
+ .
+ It spans several lines, like most real packages do.
+Homepage: https://example.org/{name}
+
+"""
+
+
+def write_status(admindir, packages):
+    with open(os.path.join(admindir, "status"), "w") as f:
+        for i in range(packages):
+            f.write(STANZA.format(name=f"pkg-{i:05d}", size=100 + i % 5000,
+                                  major=i % 7, minor=i % 13, patch=i % 31, rev=i % 3))
+    # dpkg-query also wants these to exist in the admin dir.
+    os.makedirs(os.path.join(admindir, "info"), exist_ok=True)
+    os.makedirs(os.path.join(admindir, "updates"), exist_ok=True)
+    open(os.path.join(admindir, "available"), "w").close()
+
+
+def dpkg_query_path(admindir):
+    # The pre-parser implementation of get_installed_software().
+    result = subprocess.run(['dpkg-query', f'--admindir={admindir}', '-W', '-f=${Package} ${Version}\n'],
+                            capture_output=True, text=True)
+    software = []
+    for line in result.stdout.strip().split('\n'):
+        parts = line.strip().split()
+        if len(parts) >= 2:
+            software.append({
+                "name": parts[0],
+                "version": parts[1],
+                "state": "installed",
+                "path": f"/usr/bin/{parts[0]}",
+                "type": "App"
+            })
+    return software
+
+
+def timed(fn, rounds):
+    samples = []
+    result = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packages", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    admindir = tempfile.mkdtemp(prefix="bench-dpkg-")
+    try:
+        write_status(admindir, args.packages)
+        status = os.path.join(admindir, "status")
+        size_kb = os.path.getsize(status) // 1024
+        print(f"status file: {args.packages} packages, {size_kb} KB, {args.rounds} rounds (median)")
+
+        rows = []
+        if shutil.which("dpkg-query"):
+            rows.append(("dpkg-query subprocess", *timed(lambda: dpkg_query_path(admindir), args.rounds)))
+        else:
+            print("dpkg-query not found; skipping the subprocess baseline")
+
+        rows.append(("parse_dpkg_status()", *timed(lambda: agent.parse_dpkg_status(status), args.rounds)))
+
+        agent.DPKG_STATUS = status
+        agent.get_installed_software()
+        rows.append(("cached (file unchanged)", *timed(agent.get_installed_software, args.rounds)))
+
+        for label, ms, count in rows:
+            print(f"  {label:<26} {ms:10.3f} ms  {count} packages")
+    finally:
+        shutil.rmtree(admindir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Benchmark request body encodings on realistic agent payloads.
+
+Usage: python bench_payloads.py [--packages 3000] [--services 250] [--rounds 20]
+
+Builds the bodies the agent actually sends (a full software resync from a
+synthetic dpkg status file, a services list, a process snapshot of this host
+and a sync body carrying all three), then for every encoding the client can
+pick reports:
+  * bytes on the wire
+  * agent-side encode time (serialise + compress)
+  * backend-side decode time (inflate + parse, what request.json costs)
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import zlib
+
+import agent
+import bench_dpkg
+
+UNIT_STATES = [("running", "active", "enabled"), ("exited", "active", "static"),
+               ("dead", "inactive", "disabled"), ("failed", "failed", "enabled")]
+
+
+def software_payload(packages):
+    admindir = tempfile.mkdtemp(prefix="bench-payloads-")
+    try:
+        bench_dpkg.write_status(admindir, packages)
+        software = agent.parse_dpkg_status(os.path.join(admindir, "status"))
+    finally:
+        shutil.rmtree(admindir, ignore_errors=True)
+    return {"version": "v" * 16, "full": software}
+
+
+def services_payload(count):
+    services = []
+    for i in range(count):
+        status, active, startup = UNIT_STATES[i % len(UNIT_STATES)]
+        services.append({
+            "name": f"bench-unit-{i:04d}.service",
+            "description": f"Synthetic service number {i} used for payload benchmarks",
+            "status": status,
+            "active": active,
+            "startup": startup,
+            "pid": 1000 + i if status == "running" else 0,
+            "cpu": f"{i % 7}.{i % 10}%" if status == "running" else "0%",
+            "ram": f"{10 + i % 90} MB" if status == "running" else "0 MB",
+        })
+    return services
+
+
+def encoders():
+    compressors = {"": None, "gzip": lambda d: gzip.compress(d, compresslevel=5)}
+    inflaters = {"": None, "gzip": lambda d: zlib.decompress(d, 16 + zlib.MAX_WBITS)}
+    if agent.zstandard is not None:
+        compressors["zstd"] = agent.zstandard.ZstdCompressor(level=3).compress
+        # Frames written by compress() carry no size hint, so decode via a fresh decompressobj.
+        dctx = agent.zstandard.ZstdDecompressor()
+        inflaters["zstd"] = lambda d: dctx.decompressobj().decompress(d)
+
+    serialisers = {"json": (lambda p: json.dumps(p).encode(), json.loads)}
+    if agent.msgpack is not None:
+        serialisers["msgpack"] = (lambda p: agent.msgpack.packb(p, use_bin_type=True),
+                                  lambda d: agent.msgpack.unpackb(d, raw=False, strict_map_key=False))
+
+    for name, (dump, load) in serialisers.items():
+        for codec, compress in compressors.items():
+            inflate = inflaters[codec]
+            if compress is None:
+                yield name, dump, load
+            else:
+                yield (f"{name}+{codec}",
+                       lambda p, dump=dump, compress=compress: compress(dump(p)),
+                       lambda d, load=load, inflate=inflate: load(inflate(d)))
+
+
+def timed(fn, arg, rounds):
+    samples = []
+    result = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = fn(arg)
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packages", type=int, default=3000)
+    parser.add_argument("--services", type=int, default=250)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    software = software_payload(args.packages)
+    services = services_payload(args.services)
+    processes = agent.process_snapshotter.snapshot()
+    payloads = {
+        "software resync": software,
+        "services": services,
+        "process snapshot": processes,
+        "sync (all three)": {"software": software, "services": services, "processes": processes},
+    }
+    if agent.msgpack is None or agent.zstandard is None:
+        print("msgpack and/or zstandard not installed; only the available encodings are measured")
+
+    for label, payload in payloads.items():
+        print(f"\n{label}")
+        baseline = None
+        for name, encode, decode in encoders():
+            encode_ms, data = timed(encode, payload, args.rounds)
+            decode_ms, decoded = timed(decode, data, args.rounds)
+            assert decoded == payload, f"{name} did not round-trip"
+            if baseline is None:
+                baseline = len(data)
+            print(f"  {name:<14} {len(data):>10} B  {len(data) / baseline:6.1%}"
+                  f"  encode {encode_ms:8.3f} ms  decode {decode_ms:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
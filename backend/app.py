@@ -1,26 +1,52 @@
 # app.py
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import event, func, case, or_, and_, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
 from flask_migrate import Migrate
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from flask_bcrypt import Bcrypt
-from models import db, User, ExtensionPolicy, CommandLog, DeviceReport
+from models import (db, User, ExtensionPolicy, CommandLog, DeviceReport, ReportAggregate, PendingCommand, InstalledSoftware,
+                    DeviceSyncState, MetricDevice, MetricRollup1m, MetricRollup1h, MetricRollup1d, MetricRollupState)
 from datetime import datetime, timedelta
 import traceback
+import os
+import sys
 import psutil
+import io
+import zlib
+import threading
+import json
+import time
+import uuid
+import queue
+import atexit
+import base64
+import binascii
+import re
+from urllib.parse import urlencode
+from collections import deque
+
+# Optional: compact agent request bodies. Each one is advertised to agents
+# only when installed; JSON with gzip always works.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 app = Flask(__name__)
 device_store = {}
-pending_removals = {}
-device_software_store = {}
-pending_service_actions = {}
 device_services_store = {}
-pending_process_kills = {}
+device_process_store = {}
 EXTENSION_BLACKLISTS = {}
-pending_system_actions = {}
 usb_whitelist = {}
+agent_schedules = {}
 
 # --------------------- CONFIG ---------------------
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////home/nawaz/System-Monitoring-Software/backend/data.db'  # <-- use persistent DB
@@ -34,13 +60,137 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 with app.app_context():
     db.create_all()
+    # create_all() skips indexes added to tables that already exist.
+    for index in [*DeviceReport.__table__.indexes, *CommandLog.__table__.indexes, *InstalledSoftware.__table__.indexes]:
+        index.create(db.engine, checkfirst=True)
+    # Reports stored before rollups existed stay until `flask backfill-metrics` has folded them in.
+    if not db.session.get(MetricRollupState, 1):
+        legacy_max_id = db.session.query(func.max(DeviceReport.id)).scalar() or 0
+        db.session.add(MetricRollupState(id=1, legacy_max_id=legacy_max_id, backfilled_through_id=0))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()   # another worker got there first
     if not User.query.filter_by(username='admin').first():
         hashed_password = bcrypt.generate_password_hash("admin123").decode('utf-8')
         admin = User(username="admin", password=hashed_password, role="admin")
         db.session.add(admin)
         db.session.commit()
 
+# --------------------- REQUEST DECOMPRESSION ---------------------
+MAX_INFLATED_BODY = 32 * 1024 * 1024
+MSGPACK_MIMETYPE = "application/msgpack"
+
+def inflate_gzip(raw):
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = inflater.decompress(raw, MAX_INFLATED_BODY)
+    if inflater.unconsumed_tail:
+        raise ValueError("inflated body too large")
+    return body
+
+def inflate_zstd(raw):
+    chunks, size = [], 0
+    with zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+        while True:
+            chunk = reader.read(1024 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > MAX_INFLATED_BODY:
+                raise ValueError("inflated body too large")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+REQUEST_DECODERS = {"gzip": (inflate_gzip, zlib.error)}
+if zstandard is not None:
+    REQUEST_DECODERS["zstd"] = (inflate_zstd, zstandard.ZstdError)
+
+def decode_request_body(environ):
+    """Inflate a gzip or zstd body in place. Returns (status, message) when the
+    request has to be turned away, else None."""
+    if msgpack is None and environ.get("CONTENT_TYPE", "").startswith(MSGPACK_MIMETYPE):
+        return "415 Unsupported Media Type", "MessagePack bodies are not supported by this server"
+    encoding = environ.get("HTTP_CONTENT_ENCODING", "").lower()
+    if not encoding:
+        return None
+    if encoding not in REQUEST_DECODERS:
+        return "415 Unsupported Media Type", f"Unsupported content encoding: {encoding}"
+    decode, error = REQUEST_DECODERS[encoding]
+    length = int(environ.get("CONTENT_LENGTH") or 0)
+    raw = environ["wsgi.input"].read(length) if length else environ["wsgi.input"].read()
+    try:
+        body = decode(raw)
+    except (error, ValueError) as e:
+        return "400 Bad Request", f"Invalid {encoding} body: {e}"
+    environ["wsgi.input"] = io.BytesIO(body)
+    environ["CONTENT_LENGTH"] = str(len(body))
+    del environ["HTTP_CONTENT_ENCODING"]
+    return None
+
+class DecompressRequestMiddleware:
+    """Inflates gzip and zstd request bodies from agents before Flask parses
+    them, and turns away encodings this server cannot read with a 415."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        error = decode_request_body(environ)
+        if error:
+            status, message = error
+            start_response(status, [("Content-Type", "text/plain")])
+            return [message.encode()]
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = DecompressRequestMiddleware(app.wsgi_app)
+
+class AgentRequest(Request):
+    """request.json / get_json() also decode MessagePack bodies, so routes do
+    not care which encoding the agent picked."""
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if self.mimetype != MSGPACK_MIMETYPE:
+            return super().get_json(force=force, silent=silent, cache=cache)
+        if cache and hasattr(self, "_msgpack_body"):
+            return self._msgpack_body
+        try:
+            body = msgpack.unpackb(self.get_data(cache=cache), raw=False, strict_map_key=False)
+        except Exception as e:
+            if silent:
+                return None
+            return self.on_json_loading_failed(e)
+        if cache:
+            self._msgpack_body = body
+        return body
+
+app.request_class = AgentRequest
+
+# Advertised on every response; agents pick the most compact body they share.
+ACCEPTED_BODY_ENCODINGS = ", ".join(
+    [name for name, module in (("msgpack", msgpack), ("zstd", zstandard)) if module is not None] + ["gzip"]
+)
+
+@app.after_request
+def advertise_body_encodings(response):
+    if request.path.startswith("/api/devices/"):
+        response.headers["X-Accept-Body"] = ACCEPTED_BODY_ENCODINGS
+    return response
+
 # --------------------- HELPERS ---------------------
+# In-memory caches that mirror database rows must only change once the rows
+# are committed: on_commit() defers a callback until then and drops it on rollback.
+def on_commit(callback):
+    db.session.info.setdefault("on_commit", []).append(callback)
+
+@event.listens_for(db.session, "after_commit")
+def run_commit_callbacks(session):
+    for callback in session.info.pop("on_commit", []):
+        callback()
+
+@event.listens_for(db.session, "after_rollback")
+def drop_commit_callbacks(session):
+    session.info.pop("on_commit", None)
+
 def log_action(user, action, device, details=None):
     try:
         log = CommandLog(user=user, action=action, device=device, details=details)
@@ -49,6 +199,176 @@ def log_action(user, action, device, details=None):
     except Exception as e:
         print(f"❌ Failed to log action: {e}")
 
+# Long-poll wakeups: each device has its own condition and a counter bumped
+# whenever a command is queued for it, so only that device's waiter wakes.
+command_seq = {}
+device_conditions = {}
+device_conditions_lock = threading.Lock()
+command_listeners = []  # extra wakeup hooks, called with the device id (see ingest_server.py)
+
+def device_condition(device_id):
+    with device_conditions_lock:
+        return device_conditions.setdefault(device_id, threading.Condition())
+
+def notify_device(device_id):
+    cond = device_condition(device_id)
+    with cond:
+        command_seq[device_id] = command_seq.get(device_id, 0) + 1
+        cond.notify_all()
+    for listener in command_listeners:
+        listener(device_id)
+
+# --------------------- COMMAND QUEUE ---------------------
+# Commands for agents live in the pending_commands table, so they survive
+# restarts and every backend worker sees the same queue. Each device's queue
+# is FIFO by id. Handing a command to an agent leases it: it stays invisible
+# to other fetches until it is acked or the lease runs out, and then it is
+# handed out again. Several workers can lease at once safely, because the
+# claiming UPDATE only matches rows that are still unleased.
+# "Forever" process kills are standing rules, not commands. They are sent with
+# every delivery and never leased.
+
+COMMAND_LEASE_SECONDS = 120
+COMMAND_LEASES = {("action", "patch-system"): 1800}    # (kind, payload): runs apt upgrade under one lease
+COMMAND_BATCH = 100
+COMMAND_RETENTION = timedelta(days=7)  # acked rows (and their idempotency keys)
+COMMAND_PURGE_INTERVAL = 600
+STANDING_KINDS = ("process_rule",)
+# Which list of the agent response each kind is delivered in.
+COMMAND_LISTS = {
+    "removal": "pending_removals",
+    "service_action": "service_actions",
+    "action": "actions",
+    "process_kill": "process_kills",
+    "process_rule": "process_kills",
+    "system_action": "system_actions",
+}
+last_command_purge = [0.0]
+
+def request_idempotency_key():
+    key = request.headers.get("Idempotency-Key")
+    if key is None and request.is_json:
+        key = (request.get_json(silent=True) or {}).get("idempotency_key")
+    return str(key)[:200] if key else None
+
+def enqueue_command(device_id, kind, payload, idempotency_key=None):
+    """Queue a command; returns (command, created). With an idempotency key,
+    a retried request gets back the command it already created."""
+    purge_acked_commands()
+    if idempotency_key:
+        existing = PendingCommand.query.filter_by(device_id=device_id, idempotency_key=idempotency_key).first()
+        if existing:
+            return existing, False
+    command = PendingCommand(device_id=device_id, kind=kind, payload=payload, idempotency_key=idempotency_key)
+    db.session.add(command)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker stored the same key first.
+        db.session.rollback()
+        return PendingCommand.query.filter_by(device_id=device_id, idempotency_key=idempotency_key).first(), False
+    notify_device(device_id)
+    return command, True
+
+def active_commands(device_id, kinds):
+    return PendingCommand.query.filter(
+        PendingCommand.device_id == device_id,
+        PendingCommand.acked_at.is_(None),
+        PendingCommand.kind.in_(kinds),
+    ).order_by(PendingCommand.id).all()
+
+def active_payloads(device_id, *kinds):
+    return [c.payload for c in active_commands(device_id, kinds)]
+
+def deliverable_filter(device_id, now):
+    return (PendingCommand.device_id == device_id, *deliverable_conditions(now))
+
+def deliverable_conditions(now):
+    return (
+        PendingCommand.acked_at.is_(None),
+        PendingCommand.kind.notin_(STANDING_KINDS),
+        or_(PendingCommand.lease_until.is_(None), PendingCommand.lease_until < now),
+    )
+
+def has_deliverable_commands(device_id):
+    query = db.session.query(PendingCommand.id).filter(*deliverable_filter(device_id, datetime.utcnow()))
+    return query.first() is not None
+
+def devices_with_deliverable_commands(device_ids):
+    """The subset of device_ids with something to hand out, in one query."""
+    now = datetime.utcnow()
+    rows = db.session.query(PendingCommand.device_id).filter(
+        PendingCommand.device_id.in_(device_ids),
+        *deliverable_conditions(now)
+    ).distinct()
+    return {device_id for device_id, in rows}
+
+def lease_commands(device_id):
+    now = datetime.utcnow()
+    rows = (db.session.query(PendingCommand.id, PendingCommand.kind, PendingCommand.payload)
+            .filter(*deliverable_filter(device_id, now))
+            .order_by(PendingCommand.id).limit(COMMAND_BATCH).all())
+    if not rows:
+        return []
+    candidates = [row.id for row in rows]
+    # Lease lengths are picked here, since payloads are JSON and not portably comparable in SQL.
+    long_leases = {}
+    for row in rows:
+        seconds = COMMAND_LEASES.get((row.kind, row.payload)) if isinstance(row.payload, str) else None
+        if seconds:
+            long_leases.setdefault(seconds, []).append(row.id)
+    token = uuid.uuid4().hex
+    lease_until = case(
+        *[(PendingCommand.id.in_(ids), now + timedelta(seconds=seconds)) for seconds, ids in long_leases.items()],
+        else_=now + timedelta(seconds=COMMAND_LEASE_SECONDS)
+    ) if long_leases else now + timedelta(seconds=COMMAND_LEASE_SECONDS)
+    PendingCommand.query.filter(PendingCommand.id.in_(candidates), *deliverable_filter(device_id, now)).update(
+        {"lease_token": token, "lease_until": lease_until, "attempts": PendingCommand.attempts + 1},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return PendingCommand.query.filter_by(lease_token=token).order_by(PendingCommand.id).all()
+
+def ack_command_ids(device_id, ids):
+    ids = [i for i in ids if isinstance(i, int)]
+    if not ids:
+        return 0
+    acked = PendingCommand.query.filter(
+        PendingCommand.device_id == device_id,
+        PendingCommand.id.in_(ids),
+        PendingCommand.acked_at.is_(None),
+    ).update({"acked_at": datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    return acked
+
+def ack_commands_by_payload(device_id, kinds, values, key=None, one_each=False):
+    """Ack by value, for routes and agents that predate command ids. By default
+    every active command matching one of `values` is acked; with one_each, only
+    the oldest match per value."""
+    wanted = {}
+    for value in values or []:
+        k = json.dumps(value, sort_keys=True)
+        wanted[k] = wanted.get(k, 0) + 1
+    if not wanted:
+        return 0
+    ids = []
+    for command in active_commands(device_id, kinds):
+        k = json.dumps(key(command.payload) if key else command.payload, sort_keys=True)
+        if wanted.get(k, 0) > 0:
+            ids.append(command.id)
+            if one_each:
+                wanted[k] -= 1
+    return ack_command_ids(device_id, ids)
+
+def purge_acked_commands():
+    if time.time() - last_command_purge[0] < COMMAND_PURGE_INTERVAL:
+        return
+    last_command_purge[0] = time.time()
+    PendingCommand.query.filter(PendingCommand.acked_at < datetime.utcnow() - COMMAND_RETENTION).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+
 # --------------------- AUTH ---------------------
 CORS(app, supports_credentials=True, origins=["http://192.168.32.87:3000"])
 
@@ -88,29 +408,88 @@ def me():
     return jsonify(username=current_user.username, role=current_user.role)
 
 # --------------------- COMMAND LOGS ---------------------
+# Both log endpoints page newest-first with a keyset cursor on (time, id):
+#   ?limit=  ?cursor=  ?user=  ?action=  ?start=  ?end=  (plus the device)
+# A page is a JSON array as before; when more rows exist, X-Next-Cursor (and a
+# Link rel="next" header) carry the cursor for the next page. ?format=ndjson
+# streams every matching row, one JSON object per line, fetched in keyset
+# batches so large exports never sit in memory.
+LOG_PAGE_DEFAULT = 100
+LOG_PAGE_MAX = 1000
+LOG_EXPORT_BATCH = 1000
+
+def encode_log_cursor(log):
+    return base64.urlsafe_b64encode(f"{log.time.isoformat()}|{log.id}".encode()).decode()
+
+def decode_log_cursor(cursor):
+    stamp, _, log_id = base64.urlsafe_b64decode(cursor.encode()).decode().partition("|")
+    return datetime.fromisoformat(stamp), int(log_id)
+
+def filtered_logs(device):
+    """CommandLog query for the request's filters, newest first. Raises ValueError on bad input."""
+    query = CommandLog.query
+    if device:
+        query = query.filter(CommandLog.device == device)
+    for arg, column in (("user", CommandLog.user), ("action", CommandLog.action)):
+        if request.args.get(arg):
+            query = query.filter(column == request.args[arg])
+    if request.args.get("start"):
+        query = query.filter(CommandLog.time >= datetime.fromisoformat(request.args["start"]))
+    if request.args.get("end"):
+        query = query.filter(CommandLog.time < datetime.fromisoformat(request.args["end"]))
+    return query.order_by(CommandLog.time.desc(), CommandLog.id.desc())
+
+def after_cursor(query, time_, log_id):
+    return query.filter(or_(CommandLog.time < time_, and_(CommandLog.time == time_, CommandLog.id < log_id)))
+
+def paged_logs(device, serialize):
+    try:
+        query = filtered_logs(device)
+        if request.args.get("cursor"):
+            query = after_cursor(query, *decode_log_cursor(request.args["cursor"]))
+        limit = int(request.args.get("limit", LOG_PAGE_DEFAULT))
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        limit = min(limit, LOG_PAGE_MAX)
+    except (ValueError, binascii.Error):
+        return jsonify({"error": "Invalid cursor, limit or time filter"}), 400
+
+    if request.args.get("format") == "ndjson":
+        return Response(stream_with_context(stream_logs(query, serialize)), mimetype="application/x-ndjson")
+
+    logs = query.limit(limit + 1).all()
+    response = jsonify([serialize(log) for log in logs[:limit]])
+    if len(logs) > limit:
+        cursor = encode_log_cursor(logs[limit - 1])
+        response.headers["X-Next-Cursor"] = cursor
+        response.headers["Link"] = f'<{request.path}?{urlencode({**request.args.to_dict(), "cursor": cursor})}>; rel="next"'
+    return response
+
+def stream_logs(query, serialize):
+    batch = query.limit(LOG_EXPORT_BATCH).all()
+    while batch:
+        yield "".join(json.dumps(serialize(log)) + "\n" for log in batch)
+        last = batch[-1]
+        batch = after_cursor(query, last.time, last.id).limit(LOG_EXPORT_BATCH).all()
+
 @app.route('/api/command-log')
 def command_log():
-    logs = CommandLog.query.order_by(CommandLog.time.desc()).limit(100).all()
-    return jsonify([{
+    return paged_logs(request.args.get("device"), lambda log: {
         "user": log.user,
         "action": log.action,
         "device": log.device,
         "timestamp": log.time.strftime('%Y-%m-%d %H:%M:%S')
-    } for log in logs])
+    })
 
 @app.route('/api/audit-logs')
 def get_audit_logs():
-    device_id = request.args.get("device_id")
-    logs = CommandLog.query.filter_by(device=device_id).order_by(CommandLog.time.desc()).all()
-    return jsonify([
-        {
-            "user": log.user,
-            "action": log.action,
-            "device": log.device,
-            "timestamp": log.time.isoformat(),
-            "details": log.details or "-"
-        } for log in logs
-    ])
+    return paged_logs(request.args.get("device_id"), lambda log: {
+        "user": log.user,
+        "action": log.action,
+        "device": log.device,
+        "timestamp": log.time.isoformat(),
+        "details": log.details or "-"
+    })
 
 # --------------------- DEVICE ROUTES ---------------------
 @app.route('/api/devices', methods=['GET'])
@@ -120,13 +499,50 @@ def get_devices():
 @app.route('/api/devices/<hostname>/inventory', methods=['POST'])
 def receive_inventory(hostname):
     data = request.json
+    if 'cache_key' in data:
+        body, status = apply_inventory(hostname, data)
+        return jsonify(body), status
+    save_inventory(hostname, data)
+    return jsonify({'status': 'inventory saved'})
+
+def device_sync_state(device_id):
+    state = db.session.get(DeviceSyncState, device_id)
+    if state is None:
+        state = DeviceSyncState(device_id=device_id)
+        db.session.add(state)
+    return state
+
+def apply_inventory(hostname, data):
+    """Keyed inventory from the agent's static cache: a full body under 'full',
+    or only usage figures under 'usage' when the key is unchanged. The key and
+    full body are stored in device_sync_state; usage stays in memory."""
+    key = data['cache_key']
+    if 'full' in data:
+        save_inventory(hostname, data['full'])
+        state = device_sync_state(hostname)
+        state.inventory_key, state.inventory, state.updated_at = key, data['full'], datetime.utcnow()
+        db.session.commit()
+        return {'status': 'inventory saved', 'cache_key': key}, 200
+
+    state = db.session.get(DeviceSyncState, hostname)
+    if state is None or state.inventory is None or state.inventory_key != key:
+        return {'error': 'inventory key mismatch', 'cache_key': state and state.inventory_key}, 409
+    inventory = device_store.get(hostname, {}).get('inventory')
+    if inventory is None:
+        # Another process or an earlier run of this one took the full body
+        save_inventory(hostname, dict(state.inventory))
+        inventory = device_store[hostname]['inventory']
+    inventory.update(data.get('usage', {}))
+    device_store[hostname]['status'] = 'online'
+    return {'status': 'inventory updated', 'cache_key': key}, 200
+
+def save_inventory(hostname, data):
     device_store.setdefault(hostname, {})['inventory'] = data
     device_store[hostname]['hostname'] = hostname
     device_store[hostname]['id'] = hostname
     device_store[hostname]['ip'] = data.get('ip', 'unknown')
     device_store[hostname]['os'] = data.get('os', 'unknown')
     device_store[hostname]['status'] = 'online'
-    return jsonify({'status': 'inventory saved'})
 
 @app.route('/api/devices/<hostname>/inventory', methods=['GET'])
 def get_inventory(hostname):
@@ -138,55 +554,63 @@ def get_inventory(hostname):
 # --------------------- SYSTEM ACTIONS ---------------------
 @app.route('/api/devices/<device_id>/action/shutdown', methods=['POST'])
 def request_shutdown(device_id):
-    pending_system_actions.setdefault(device_id, []).append('shutdown')
-    log_action(current_user.username, "Shutdown", device_id)
-    return jsonify({"status": "shutdown requested"})
+    command, created = enqueue_command(device_id, "system_action", "shutdown", request_idempotency_key())
+    if created:
+        log_action(current_user.username, "Shutdown", device_id)
+    return jsonify({"status": "shutdown requested", "command_id": command.id})
     
 
 @app.route('/api/devices/<device_id>/action/restart', methods=['POST'])
 def request_restart(device_id):
-    pending_system_actions.setdefault(device_id, []).append('restart')
-    log_action(current_user.username, "Restart", device_id)
-    return jsonify({"status": "restart requested"})
+    command, created = enqueue_command(device_id, "system_action", "restart", request_idempotency_key())
+    if created:
+        log_action(current_user.username, "Restart", device_id)
+    return jsonify({"status": "restart requested", "command_id": command.id})
 
 @app.route('/api/devices/<device_id>/action/lock', methods=['POST'])
 def lock_user(device_id):
-    pending_service_actions.setdefault(device_id, []).append("lock-user")
-    log_action(current_user.username, "Lock User", device_id)
-    return jsonify({"status": "lock queued"})
+    command, created = enqueue_command(device_id, "action", "lock-user", request_idempotency_key())
+    if created:
+        log_action(current_user.username, "Lock User", device_id)
+    return jsonify({"status": "lock queued", "command_id": command.id})
 
 @app.route('/api/devices/<device_id>/action/unlock', methods=['POST'])
 def unlock_user(device_id):
-    pending_service_actions.setdefault(device_id, []).append("unlock-user")
-    log_action(current_user.username, "Unlock User", device_id)
-    return jsonify({"status": "unlock queued"})
+    command, created = enqueue_command(device_id, "action", "unlock-user", request_idempotency_key())
+    if created:
+        log_action(current_user.username, "Unlock User", device_id)
+    return jsonify({"status": "unlock queued", "command_id": command.id})
 
 @app.route('/api/devices/<device_id>/actions/pending', methods=['GET'])
 def get_pending_system_actions(device_id):
-    return jsonify(pending_system_actions.get(device_id, []))
+    return jsonify(active_payloads(device_id, "system_action"))
 
 
 @app.route('/api/devices/<device_id>/action/enable-usb', methods=['POST'])
 def enable_usb_temporarily(device_id):
     data = request.json or {}
     duration_minutes = int(data.get("duration", 15))
-    until_time = datetime.datetime.utcnow() + datetime.timedelta(minutes=duration_minutes)
+    until_time = datetime.utcnow() + timedelta(minutes=duration_minutes)
     usb_whitelist[device_id] = {"until": until_time.isoformat()}
     log_action(current_user.username, f"Enable USB for {duration_minutes} min", device_id)
+    notify_device(device_id)
     return jsonify({"status": "usb enabled", "until": until_time.isoformat()})
 
 @app.route('/api/devices/<device_id>/action/usb-enable-pending', methods=['GET'])
 def get_usb_enable_pending(device_id):
+    return jsonify({"enable_usb": usb_enable_active(device_id)})
+
+def usb_enable_active(device_id):
     entry = usb_whitelist.get(device_id)
     if not entry:
-        return jsonify({"enable_usb": False})
+        return False
+
+    expiry = datetime.fromisoformat(entry["until"])
+    if expiry > datetime.utcnow():
+        return True
 
-    expiry = datetime.datetime.fromisoformat(entry["until"])
-    if expiry > datetime.datetime.utcnow():
-        return jsonify({"enable_usb": True})
-    
     usb_whitelist.pop(device_id, None)
-    return jsonify({"enable_usb": False})
+    return False
 
 
 # ---------------- EXTENSIONS ----------------
@@ -213,6 +637,7 @@ def update_policy(device_id):
             ))
     db.session.commit()
     log_action(current_user.username, "Update Whitelist Policy", device_id, details=f"Updated: {list(data.keys())}")
+    notify_device(device_id)
     return jsonify({"status": "success"})
 
 @app.route('/api/devices/<device_id>/extension-blacklist', methods=['GET'])
@@ -228,15 +653,18 @@ def update_blacklist(device_id):
         db.session.add(ExtensionPolicy(device_id=device_id, ext_type="blacklist", name=name))
     db.session.commit()
     log_action(current_user.username, "Update Extension Blacklist", device_id, details=f"Blacklisted: {data.get('vscode')}")
+    notify_device(device_id)
     return jsonify({"status": "blacklist updated"})
 
 @app.route('/api/devices/<device_id>/extensions', methods=['POST'])
 def receive_extensions(device_id):
-    data = request.json
+    save_extensions(device_id, request.json)
+    return jsonify({"status": "extensions received"})
+
+def save_extensions(device_id, data):
     if device_id not in device_store:
         device_store[device_id] = {"id": device_id}
     device_store[device_id]["extensions"] = data
-    return jsonify({"status": "extensions received"})
 
 @app.route('/api/devices/<device_id>/extensions', methods=['GET'])
 def get_device_extensions(device_id):
@@ -244,46 +672,193 @@ def get_device_extensions(device_id):
 
 @app.route('/api/devices/<device_id>/extensions/<ext_name>', methods=['DELETE'])
 def request_extension_removal(device_id, ext_name):
-    if device_id not in pending_removals:
-        pending_removals[device_id] = []
-    pending_removals[device_id].append(ext_name)
-    log_action(current_user.username, "Remove Extension", device_id, details=ext_name)
-    return jsonify({"status": "marked for removal"})
+    command, created = enqueue_command(device_id, "removal", ext_name, request_idempotency_key())
+    if created:
+        log_action(current_user.username, "Remove Extension", device_id, details=ext_name)
+    return jsonify({"status": "marked for removal", "command_id": command.id})
 
 @app.route('/api/devices/<device_id>/extensions/pending-removal', methods=['GET'])
 def get_pending_removals(device_id):
-    return jsonify(pending_removals.get(device_id, []))
+    return jsonify(active_payloads(device_id, "removal"))
 
 
 # ---------------- SOFTWARE ----------------
 
+# Installed packages live in the installed_software table, one row per
+# (device, package), with a (name, version) index as the fleet-wide inverted
+# index. Pushes only write the rows that changed. device_sync_state holds the
+# snapshot version the agent last synced, used to validate incoming deltas; it
+# is committed with the rows it describes.
+
+def software_items(items):
+    # Running processes have their own endpoint; older agents still mix them in.
+    return {item["name"]: item for item in items
+            if isinstance(item, dict) and item.get("name") and item.get("type") != "process"}
+
+def store_device_software(device_id, items, removed=(), full=False, version=None):
+    """Upsert the given records and delete `removed`; with full=True, every
+    stored package missing from `items` is removed instead. Records `version`
+    as the device's snapshot version in the same commit."""
+    incoming = software_items(items)
+    query = InstalledSoftware.query.filter_by(device_id=device_id)
+    if not full:
+        query = query.filter(InstalledSoftware.name.in_([*incoming, *removed]))
+    existing = {row.name: row for row in query}
+    if full:
+        removed = [name for name in existing if name not in incoming]
+
+    for name in removed:
+        if name in existing:
+            db.session.delete(existing[name])
+    now = datetime.utcnow()
+    for name, item in incoming.items():
+        row = existing.get(name)
+        if row is None:
+            db.session.add(InstalledSoftware(device_id=device_id, name=name, version=str(item.get("version") or ""),
+                                             item=item, updated_at=now))
+        elif row.item != item:
+            row.version, row.item, row.updated_at = str(item.get("version") or ""), item, now
+    state = device_sync_state(device_id)
+    state.software_version, state.updated_at = version, now
+    db.session.commit()
+
 @app.route('/api/devices/<device_id>/software', methods=['POST'])
 def receive_software(device_id):
-    data = request.json
-    if device_id not in device_software_store:
-        device_software_store[device_id] = []
-    existing = device_software_store[device_id]
-    all_names = {s["name"]: s for s in existing}
-    for item in data:
-        all_names[item["name"]] = item
-    device_software_store[device_id] = list(all_names.values())
+    # A full-list push bypasses delta versioning; version=None forces the next delta to resync.
+    store_device_software(device_id, request.json or [], full=True)
     return jsonify({"status": "software received"}), 200
 
+@app.route('/api/devices/<device_id>/software/delta', methods=['POST'])
+def receive_software_delta(device_id):
+    body, status = apply_software_delta(device_id, request.json or {})
+    return jsonify(body), status
+
+def apply_software_delta(device_id, data):
+    version = data.get("version")
+    if not version:
+        return {"error": "version is required"}, 400
+
+    if "full" in data:
+        store_device_software(device_id, data["full"], full=True, version=version)
+        return {"status": "software resynced", "version": version}, 200
+
+    state = db.session.get(DeviceSyncState, device_id)
+    current = state and state.software_version
+    if current is None or data.get("base") != current:
+        return {"error": "version mismatch", "version": current}, 409
+
+    items, removed = data.get("added", []) + data.get("changed", []), data.get("removed", [])
+    # The agent sends an empty delta every cycle its package list is unchanged
+    if items or removed or version != current:
+        store_device_software(device_id, items, removed=removed, version=version)
+    return {"status": "software delta applied", "version": version}, 200
+
 @app.route('/api/devices/<device_id>/software', methods=['GET'])
 def get_software_info(device_id):
-    return jsonify(device_software_store.get(device_id, []))
-
-@app.route('/api/devices/<device_id>/software/<software_name>', methods=['DELETE'])
-def request_software_uninstall(device_id, software_name):
-    if device_id not in pending_removals:
-        pending_removals[device_id] = []
-    pending_removals[device_id].append(software_name)
-    log_action(current_user.username, "Uninstall Software", device_id, details=software_name)
-    return jsonify({"status": "marked for uninstall"})
+    rows = InstalledSoftware.query.filter_by(device_id=device_id).order_by(InstalledSoftware.name)
+    return jsonify([row.item for row in rows])
+
+# Debian (dpkg) version ordering: [epoch:]upstream[-revision], digits compared
+# numerically, letters before other symbols and '~' before everything, even
+# the end of the string. Close enough for RPM and most upstream versions too.
+VERSION_CONSTRAINT = re.compile(r"^\s*(<=|>=|!=|==|=|<|>)?\s*(\S+)\s*$")
+VERSION_OPS = {
+    "<": lambda c: c < 0, "<=": lambda c: c <= 0, ">": lambda c: c > 0, ">=": lambda c: c >= 0,
+    "=": lambda c: c == 0, "==": lambda c: c == 0, "!=": lambda c: c != 0,
+}
+SOFTWARE_SEARCH_LIMIT = 5000
+
+def version_char_order(fragment, i):
+    if i >= len(fragment) or fragment[i].isdigit():
+        return 0
+    c = fragment[i]
+    if c.isalpha():
+        return ord(c)
+    return -1 if c == "~" else ord(c) + 256
+
+def compare_version_fragment(a, b):
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac, bc = version_char_order(a, i), version_char_order(b, j)
+            if ac != bc:
+                return ac - bc
+            i, j = i + 1, j + 1
+        start_i, start_j = i, j
+        while i < len(a) and a[i].isdigit():
+            i += 1
+        while j < len(b) and b[j].isdigit():
+            j += 1
+        diff = int(a[start_i:i] or 0) - int(b[start_j:j] or 0)
+        if diff:
+            return diff
+    return 0
+
+def split_version(version):
+    epoch, sep, rest = version.partition(":")
+    if not sep or not epoch.isdigit():
+        epoch, rest = "0", version
+    upstream, sep, revision = rest.rpartition("-")
+    if not sep:
+        upstream, revision = rest, ""
+    return int(epoch), upstream, revision
+
+def compare_versions(a, b):
+    (epoch_a, upstream_a, revision_a), (epoch_b, upstream_b, revision_b) = split_version(a), split_version(b)
+    return (epoch_a - epoch_b
+            or compare_version_fragment(upstream_a, upstream_b)
+            or compare_version_fragment(revision_a, revision_b))
+
+@app.route('/api/software/search', methods=['GET'])
+def search_software():
+    """Fleet-wide package lookup, answered from the (name, version, device_id) index.
+
+    ?name=openssl            devices with that exact package
+    ?prefix=libssl           packages whose name starts with it
+    &version=<3.0.2          optional constraint: <, <=, >, >=, =, != (dpkg ordering)
+    &summary=1               only the device count per (name, version)
+    """
+    name, prefix = request.args.get("name"), request.args.get("prefix")
+    if not name and not prefix:
+        return jsonify({"error": "name or prefix is required"}), 400
+    constraint = None
+    if request.args.get("version"):
+        match = VERSION_CONSTRAINT.match(request.args["version"])
+        if not match:
+            return jsonify({"error": "version must look like '<3.0.2' or '=1.2-1'"}), 400
+        op, wanted = match.group(1) or "=", match.group(2)
+        constraint = lambda version: VERSION_OPS[op](compare_versions(version, wanted))
+
+    if name:
+        by_name = InstalledSoftware.name == name
+    else:
+        # A range instead of LIKE, so the index is used
+        by_name = and_(InstalledSoftware.name >= prefix, InstalledSoftware.name < prefix + "\U0010ffff")
+
+    # Versions are compared per distinct (name, version), not per device.
+    versions = [(n, v, count) for n, v, count in db.session.query(
+        InstalledSoftware.name, InstalledSoftware.version, func.count()
+    ).filter(by_name).group_by(InstalledSoftware.name, InstalledSoftware.version)
+        if constraint is None or constraint(v)]
+    total = sum(count for _, _, count in versions)
+
+    if request.args.get("summary"):
+        return jsonify({
+            "installs": total,
+            "packages": [{"name": n, "version": v, "devices": count} for n, v, count in versions],
+        })
 
-@app.route('/api/devices/<device_id>/software/pending-removal', methods=['GET'])
-def get_software_pending_removal(device_id):
-    return jsonify(pending_removals.get(device_id, []))
+    rows = []
+    if versions:
+        rows = db.session.query(InstalledSoftware.device_id, InstalledSoftware.name, InstalledSoftware.version).filter(
+            by_name,
+            tuple_(InstalledSoftware.name, InstalledSoftware.version).in_([(n, v) for n, v, _ in versions])
+        ).order_by(InstalledSoftware.name, InstalledSoftware.version).limit(SOFTWARE_SEARCH_LIMIT).all()
+    return jsonify({
+        "count": total,
+        "matches": [{"device_id": d, "name": n, "version": v} for d, n, v in rows],
+        "truncated": total > len(rows),
+    })
 
 
 # ---------------- SERVICES ----------------
@@ -299,49 +874,80 @@ def get_services(device_id):
 
 @app.route('/api/devices/<device_id>/services/<service_name>/<action>', methods=['POST'])
 def queue_service_action(device_id, service_name, action):
-    if device_id not in pending_service_actions:
-        pending_service_actions[device_id] = []
-    pending_service_actions[device_id].append({
+    command, created = enqueue_command(device_id, "service_action", {
         "service": service_name,
         "action": action,
-        "timestamp": datetime.datetime.utcnow().isoformat()
-    })
-    log_action(current_user.username, f"Service {action.capitalize()}", device_id, details=service_name)
-    return jsonify({"status": "queued", "action": action})
+        "timestamp": datetime.utcnow().isoformat()
+    }, request_idempotency_key())
+    if created:
+        log_action(current_user.username, f"Service {action.capitalize()}", device_id, details=service_name)
+    return jsonify({"status": "queued", "action": action, "command_id": command.id})
 
 @app.route('/api/devices/<device_id>/services/pending-actions', methods=['GET'])
 def get_pending_service_actions(device_id):
-    return jsonify(pending_service_actions.get(device_id, []))
+    return jsonify(active_payloads(device_id, "service_action", "action"))
 
 @app.route('/api/devices/<device_id>/services/clear-completed', methods=['POST'])
 def clear_completed_service_actions(device_id):
-    completed = request.json
-    if device_id in pending_service_actions:
-        pending_service_actions[device_id] = [
-            a for a in pending_service_actions[device_id]
-            if a not in completed
-        ]
+    completed = request.get_json(silent=True) or []
+    ack_commands_by_payload(device_id, ("service_action", "action"), completed)
     return jsonify({"status": "cleared"})
 
 
+# ---------------- PROCESSES ----------------
+# Latest process snapshots per device: the top consumers plus a per-name
+# summary. Only the last PROCESS_HISTORY snapshots are kept, each capped.
+
+PROCESS_HISTORY = 10
+PROCESS_TOP_MAX = 50
+PROCESS_NAMES_MAX = 1000
+
+def save_process_snapshot(device_id, snapshot):
+    if not isinstance(snapshot, dict):
+        return
+    names = snapshot.get("names") or {}
+    if len(names) > PROCESS_NAMES_MAX:
+        names = dict(sorted(names.items(), key=lambda kv: kv[1].get("rss", 0), reverse=True)[:PROCESS_NAMES_MAX])
+    history = device_process_store.setdefault(device_id, deque(maxlen=PROCESS_HISTORY))
+    history.append({
+        "timestamp": snapshot.get("timestamp") or datetime.utcnow().isoformat(),
+        "interval": snapshot.get("interval"),
+        "total": snapshot.get("total", len(names)),
+        "top": list(snapshot.get("top") or [])[:PROCESS_TOP_MAX],
+        "names": names,
+    })
+
+@app.route('/api/devices/<device_id>/processes', methods=['POST'])
+def receive_processes(device_id):
+    save_process_snapshot(device_id, request.get_json(silent=True))
+    return jsonify({"status": "processes received"}), 200
+
+@app.route('/api/devices/<device_id>/processes', methods=['GET'])
+def get_processes(device_id):
+    history = device_process_store.get(device_id)
+    if not history:
+        return jsonify({})
+    if request.args.get("history"):
+        return jsonify(list(history))
+    return jsonify(history[-1])
+
+
 # ---------------- PROCESS KILL (RUN ONCE / INDEFINITE) ----------------
 
 @app.route('/api/devices/<device_id>/processes/<name>/kill', methods=['POST'])
 def queue_process_kill(device_id, name):
     data = request.json or {}
     mode = data.get("mode", "once")  # mode can be 'once' or 'forever'
-
-    if device_id not in pending_process_kills:
-        pending_process_kills[device_id] = []
+    kind = "process_rule" if mode == "forever" else "process_kill"
 
     # Avoid duplicates
-    exists = any(entry["name"] == name and entry["mode"] == mode for entry in pending_process_kills[device_id])
+    exists = any(entry.get("name") == name for entry in active_payloads(device_id, kind))
     if not exists:
-        pending_process_kills[device_id].append({
+        enqueue_command(device_id, kind, {
             "name": name,
             "mode": mode,
-            "timestamp": datetime.datetime.now().isoformat()
-        })
+            "timestamp": datetime.now().isoformat()
+        }, request_idempotency_key())
         print(f"📦 Queued process kill: {name} ({mode}) for {device_id}")
         log_action(current_user.username, "Kill Process", device_id, details=f"{name} ({mode})")
     return jsonify({"status": "queued", "process": name, "mode": mode})
@@ -349,36 +955,22 @@ def queue_process_kill(device_id, name):
 
 @app.route('/api/devices/<device_id>/processes/pending-kill', methods=['GET'])
 def get_pending_process_kills(device_id):
-    return jsonify(pending_process_kills.get(device_id, []))
+    return jsonify(active_payloads(device_id, "process_kill", "process_rule"))
 
 @app.route("/api/devices/<device_id>/processes/<name>/kill/complete", methods=["POST"])
 def clear_kill_queue(device_id, name):
-    if device_id in pending_process_kill:
-        pending_process_kill[device_id] = [p for p in pending_process_kill[device_id] if p != name]
+    ack_commands_by_payload(device_id, ("process_kill",), [name], key=lambda p: p.get("name"))
     return jsonify({"status": "removed", "target": name})
 
 @app.route('/api/devices/<device_id>/processes/pending-kill/<name>', methods=['DELETE'])
 def delete_pending_kill(device_id, name):
-    if device_id not in pending_process_kills:
-        return jsonify({"message": "Device not found"}), 404
-
-    before = pending_process_kills[device_id]
-    print(f"🔍 Before delete: {before}")
-
-    updated = []
-    deleted = False
-
-    for item in before:
-        # Match exactly name AND mode
-        if item.get("name") == name and item.get("mode") == "once":
-            deleted = True
-            continue  # Skip this item (delete)
-        updated.append(item)
-
-    if not deleted:
+    matches = [c for c in active_commands(device_id, ("process_kill",)) if c.payload.get("name") == name]
+    if not matches:
         return jsonify({"message": "No matching kill entry found"}), 404
 
-    pending_process_kills[device_id] = updated
+    for command in matches:
+        db.session.delete(command)
+    db.session.commit()
     print(f"✅ Cleared 'once' mode kill for '{name}' on {device_id}")
     return jsonify({"status": "cleared"}), 200
 
@@ -386,32 +978,29 @@ def delete_pending_kill(device_id, name):
 
 @app.route('/api/devices/<device_id>/actions/patch-system', methods=['POST'])
 def trigger_patch_system(device_id):
-    if device_id not in pending_service_actions:
-        pending_service_actions[device_id] = []
-    pending_service_actions[device_id].append("patch-system")
-    log_action(current_user.username, "Patch System", device_id)
-    return jsonify({"status": "patch queued"})
+    command, created = enqueue_command(device_id, "action", "patch-system", request_idempotency_key())
+    if created:
+        log_action(current_user.username, "Patch System", device_id)
+    return jsonify({"status": "patch queued", "command_id": command.id})
 
 @app.route('/api/devices/<device_id>/actions', methods=['GET'])
 def get_pending_actions(device_id):
-    return jsonify(pending_service_actions.get(device_id, []))
+    return jsonify(active_payloads(device_id, "service_action", "action"))
 
 @app.route('/api/devices/<device_id>/actions/patch-result', methods=['POST'])
 def receive_patch_result(device_id):
-    data = request.json
+    store_patch_result(device_id, request.json)
+    return jsonify({"status": "result stored"})
+
+def store_patch_result(device_id, data):
     result = {
         "status": data.get("status", "unknown"),
-        "timestamp": datetime.datetime.utcnow().isoformat()
+        "timestamp": datetime.utcnow().isoformat()
     }
     if "patch_results" not in device_store:
         device_store["patch_results"] = {}
     device_store["patch_results"][device_id] = result
-
-    if device_id in pending_service_actions:
-        pending_service_actions[device_id] = [
-            a for a in pending_service_actions[device_id] if a != "patch-system"
-        ]
-    return jsonify({"status": "result stored"})
+    ack_commands_by_payload(device_id, ("action",), ["patch-system"])
 
 @app.route('/api/devices/<device_id>/actions/patch-status', methods=['GET'])
 def get_patch_status(device_id):
@@ -420,23 +1009,49 @@ def get_patch_status(device_id):
         return jsonify({"status": "pending"})
     return jsonify(result)
 
-#------------------Dashboard UI---------------
+# ---------------- AGENT CONFIG ----------------
+# Per-collector schedule overrides for agents running with --daemon.
+# Device id "*" holds fleet-wide defaults; per-device entries win over them.
 
-@app.route('/api/dashboard/stats', methods=['GET'])
-def get_dashboard_stats():
-    # Total distinct devices
-    total_devices = db.session.query(DeviceReport.hostname).distinct().count()
+@app.route('/api/devices/<device_id>/agent-config', methods=['GET'])
+def get_agent_config(device_id):
+    return jsonify({"schedule": merged_agent_schedule(device_id)})
 
-    # Get latest report per device
-    latest_reports = db.session.query(DeviceReport.hostname, func.max(DeviceReport.timestamp)).group_by(DeviceReport.hostname).all()
+# Settings the agent accepts per config entry; "governor" carries the agent's
+# CPU and memory budget rather than a collector schedule.
+AGENT_CONFIG_KEYS = {"governor": ("cpu_percent", "memory_mb")}
+SCHEDULE_KEYS = ("interval", "jitter")
 
-    online_devices = 0
-    now = datetime.utcnow()
+def merged_agent_schedule(device_id):
+    schedule = {}
+    for source in (agent_schedules.get("*", {}), agent_schedules.get(device_id, {})):
+        for name, cfg in source.items():
+            schedule.setdefault(name, {}).update(cfg)
+    return schedule
+
+@app.route('/api/devices/<device_id>/agent-config', methods=['POST'])
+def update_agent_config(device_id):
+    data = request.json or {}
+    schedule = data.get("schedule", {})
+    if not isinstance(schedule, dict):
+        return jsonify({"error": "schedule must be an object"}), 400
+
+    current = agent_schedules.setdefault(device_id, {})
+    for name, cfg in schedule.items():
+        if cfg is None:
+            current.pop(name, None)
+        elif isinstance(cfg, dict):
+            allowed = AGENT_CONFIG_KEYS.get(name, SCHEDULE_KEYS)
+            current.setdefault(name, {}).update({k: v for k, v in cfg.items() if k in allowed})
+    log_action(current_user.username, "Update Agent Schedule", device_id, details=f"Collectors: {list(schedule.keys())}")
+    notify_device(device_id)
+    return jsonify({"status": "schedule updated", "schedule": current})
 
-    for hostname, last_seen in latest_reports:
-        if now - last_seen < timedelta(minutes=2):  # adjust as per agent interval
-            online_devices += 1
+#------------------Dashboard UI---------------
 
+@app.route('/api/dashboard/stats', methods=['GET'])
+def get_dashboard_stats():
+    total_devices, online_devices = fleet_counts()
     offline_devices = total_devices - online_devices
 
     # Recent activity (last 10 actions)
@@ -458,12 +1073,67 @@ def get_dashboard_stats():
 
 @app.route('/api/devices/<device_id>/report', methods=['POST'])
 def report_device(device_id):
-    data = request.get_json()
-    print(f"[DEBUG] Device Report from {device_id}: {data}")
+    data = request.get_json(silent=True)
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
+    error = validate_report(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if not enqueue_report(data, datetime.utcnow(), timeout=INGEST_ENQUEUE_TIMEOUT):
+        # The agent spools on 5xx and replays through the batch endpoint later
+        return jsonify({"error": "Ingest queue full, retry later"}), 503, {"Retry-After": str(INGEST_RETRY_AFTER)}
+    return jsonify({"message": "Report queued"}), 202
 
-    report = DeviceReport(
+def parse_agent_time(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+# Skew is rounded so a resent batch, whose transit time differs, maps its
+# reports onto the same timestamps and is still de-duplicated.
+CLOCK_SKEW_RESOLUTION = 60
+
+def agent_clock_skew(sent_at):
+    """How far the server clock is ahead of the agent's, from the agent's
+    send time; zero when the agent did not say."""
+    sent = parse_agent_time(sent_at)
+    if not sent:
+        return timedelta(0)
+    steps = round((datetime.utcnow() - sent).total_seconds() / CLOCK_SKEW_RESOLUTION)
+    return timedelta(seconds=steps * CLOCK_SKEW_RESOLUTION)
+
+def report_timestamp(data, skew=timedelta(0)):
+    """Timestamp of a spooled report on the server's clock, never in the future.
+    Live reports do not use this: they are stamped when received."""
+    now = datetime.utcnow()
+    taken = parse_agent_time(data.get('timestamp'))
+    return min(taken + skew, now) if taken else now
+
+REPORT_METRICS = ("cpu", "ram", "disk")
+AGGREGATE_FIELDS = ("min", "max", "mean", "p95", "last")
+
+def build_report_aggregates(data):
+    aggregates = data.get('aggregates')
+    if not isinstance(aggregates, dict):
+        return []
+    rows = []
+    for metric in REPORT_METRICS:
+        values = aggregates.get(metric)
+        if not isinstance(values, dict):
+            continue
+        try:
+            fields = {field: float(values[field]) for field in AGGREGATE_FIELDS if values.get(field) is not None}
+            samples = int(aggregates.get('samples') or 0)
+            window = float(aggregates.get('window_seconds') or 0)
+        except (TypeError, ValueError):
+            continue
+        rows.append(ReportAggregate(metric=metric, samples=samples, window_seconds=window, **fields))
+    return rows
+
+def build_device_report(data, timestamp):
+    return DeviceReport(
         hostname=data.get('hostname'),
         os=data.get('os'),
         ip=data.get('ip'),
@@ -471,15 +1141,604 @@ def report_device(device_id):
         cpu=data.get('cpu'),
         ram=data.get('ram'),
         disk=data.get('disk'),
-        timestamp=datetime.utcnow()
+        timestamp=timestamp,
+        aggregates=build_report_aggregates(data)
     )
+
+def save_device_report(data, received_at):
+    report = build_device_report(data, received_at)
     db.session.add(report)
+    record_metrics([report])
     db.session.commit()
-    return jsonify({"message": "Report saved successfully"}), 201
+
+# ---------------- REPORT INGEST ----------------
+# Live reports are validated in the request and handed to a bounded queue.
+# One writer thread drains it and commits up to INGEST_BATCH_ROWS reports per
+# transaction, or whatever arrived within INGEST_FLUSH_MS of the first one, so
+# the database sees one commit (one fsync on SQLite) per batch instead of per
+# report. When the queue is full, requests wait up to INGEST_ENQUEUE_TIMEOUT
+# and then get a 503, which makes agents spool and back off. The queue is
+# drained before the process exits.
+#
+# A live report is stamped with the time the server received it, not the
+# agent's clock: online status and the batch de-duplication both key on it,
+# and agent clocks drift.
+
+INGEST_QUEUE_MAX = 10000
+INGEST_BATCH_ROWS = 500
+INGEST_FLUSH_MS = 200
+INGEST_ENQUEUE_TIMEOUT = 2.0
+INGEST_RETRY_AFTER = 30
+INGEST_STOP = object()
+report_queue = queue.Queue(maxsize=INGEST_QUEUE_MAX)
+ingest_writer = [None]
+ingest_lock = threading.Lock()
+
+def validate_report(data):
+    if not isinstance(data, dict):
+        return "Report must be a JSON object"
+    if not isinstance(data.get('hostname'), str) or not data['hostname']:
+        return "hostname is required"
+    for metric in REPORT_METRICS:
+        value = data.get(metric)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            return f"{metric} must be a number"
+    return None
+
+def enqueue_report(data, received_at, timeout=0):
+    start_metric_retention()
+    with ingest_lock:
+        if ingest_writer[0] is None:
+            ingest_writer[0] = threading.Thread(target=run_ingest_writer, name="report-writer", daemon=True)
+            ingest_writer[0].start()
+    try:
+        if timeout:
+            report_queue.put((data, received_at), timeout=timeout)
+        else:
+            report_queue.put_nowait((data, received_at))
+        return True
+    except queue.Full:
+        return False
+
+def next_ingest_batch():
+    """Block for the first report, then collect more until the batch is full
+    or the flush deadline passes. Returns (batch, stop)."""
+    first = report_queue.get()
+    if first is INGEST_STOP:
+        return [], True
+    batch = [first]
+    deadline = time.monotonic() + INGEST_FLUSH_MS / 1000
+    while len(batch) < INGEST_BATCH_ROWS:
+        remaining = deadline - time.monotonic()
+        try:
+            item = report_queue.get(timeout=remaining) if remaining > 0 else report_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is INGEST_STOP:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+def write_report_batch(batch):
+    try:
+        reports = [build_device_report(data, received_at) for data, received_at in batch]
+        db.session.add_all(reports)
+        record_metrics(reports)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[ERROR] Batch insert of {len(batch)} reports failed, retrying one by one: {e}")
+        for data, received_at in batch:
+            try:
+                save_device_report(data, received_at)
+            except Exception as e:
+                db.session.rollback()
+                print(f"[ERROR] Dropping report from {data.get('hostname')}: {e}")
+
+def run_ingest_writer():
+    stop = False
+    while not stop:
+        batch, stop = next_ingest_batch()
+        if batch:
+            with app.app_context():
+                write_report_batch(batch)
+
+@atexit.register
+def flush_ingest_queue():
+    writer = ingest_writer[0]
+    if writer is None or not writer.is_alive():
+        return
+    # Blocks while the queue is full; the writer keeps draining until it sees this
+    report_queue.put(INGEST_STOP)
+    writer.join(timeout=30)
+    if writer.is_alive():
+        print(f"[ERROR] Report writer did not finish; about {report_queue.qsize()} reports left unwritten")
+
+@app.route('/api/devices/<device_id>/reports/batch', methods=['POST'])
+def receive_report_batch(device_id):
+    """Bulk ingest of reports an agent spooled while offline. Report times are
+    moved onto the server clock using the batch's sent_at. Idempotent: a
+    report whose (hostname, timestamp) is already stored is skipped."""
+    data = request.get_json(silent=True) or {}
+    skew = agent_clock_skew(data.get("sent_at"))
+    reports = [build_device_report(r, report_timestamp(r, skew))
+               for r in data.get("reports", []) if isinstance(r, dict)]
+    if not reports:
+        return jsonify({"received": 0, "inserted": 0})
+
+    hostnames = {r.hostname for r in reports}
+    start = min(r.timestamp for r in reports)
+    end = max(r.timestamp for r in reports)
+    existing = set(db.session.query(DeviceReport.hostname, DeviceReport.timestamp).filter(
+        DeviceReport.hostname.in_(hostnames),
+        DeviceReport.timestamp >= start,
+        DeviceReport.timestamp <= end
+    ).all())
+
+    fresh = []
+    for r in reports:
+        key = (r.hostname, r.timestamp)
+        if key not in existing:
+            existing.add(key)
+            fresh.append(r)
+    db.session.add_all(fresh)
+    record_metrics(fresh)
+    db.session.commit()
+    return jsonify({"received": len(reports), "inserted": len(fresh)})
+
+# ---------------- METRICS STORE ----------------
+# Raw reports stay in device_report for a short window. On ingest, every
+# report is also folded into per-device 1-minute, 1-hour and 1-day rollup
+# rows (report count, and count/sum/min/max per metric) with one upsert per
+# bucket, in the same transaction as the report itself. Dashboards and
+# history read the rollups, so their cost depends on the time range asked
+# for, not on how many reports were stored.
+#
+# Retention is a separate job (a background thread while ingesting, or
+# `flask purge-metrics`) that deletes in bounded chunks. It never deletes a
+# raw report that has not been rolled up: reports stored before rollups
+# existed are kept until `flask backfill-metrics` has passed them.
+
+METRICS = ("cpu", "ram", "disk")
+METRIC_ROLLUPS = {
+    "1m": (MetricRollup1m, timedelta(minutes=1)),
+    "1h": (MetricRollup1h, timedelta(hours=1)),
+    "1d": (MetricRollup1d, timedelta(days=1)),
+}
+METRIC_RETENTION = {
+    "raw": timedelta(days=2),
+    "1m": timedelta(days=14),
+    "1h": timedelta(days=400),
+    "1d": timedelta(days=1825),
+}
+METRIC_PURGE_INTERVAL = 600
+METRIC_PURGE_CHUNK = 2000       # rows per delete statement / transaction
+METRIC_PURGE_MAX_CHUNKS = 50    # per table per pass; the next pass picks up the rest
+METRIC_BACKFILL_BATCH = 5000
+metric_device_ids = {}      # hostname -> metric_devices.id, filled only after commit
+metric_retention = [None]
+metric_retention_lock = threading.Lock()
+
+def upsert(model):
+    dialect = postgresql if db.engine.dialect.name == "postgresql" else sqlite
+    return dialect.insert(model)
+
+def bucket_start(ts, resolution):
+    if resolution == "1m":
+        return ts.replace(second=0, microsecond=0)
+    if resolution == "1h":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def metric_device_id(hostname):
+    if hostname in metric_device_ids:
+        return metric_device_ids[hostname]
+    # Ids resolved in this transaction are only cached once it commits.
+    pending = db.session.info.setdefault("metric_device_ids", {})
+    if hostname not in pending:
+        db.session.execute(upsert(MetricDevice).values(hostname=hostname).on_conflict_do_nothing(
+            index_elements=["hostname"]))
+        device_id = db.session.query(MetricDevice.id).filter_by(hostname=hostname).scalar()
+        pending[hostname] = device_id
+        on_commit(lambda: metric_device_ids.__setitem__(hostname, device_id))
+    return pending[hostname]
+
+@event.listens_for(db.session, "after_commit")
+@event.listens_for(db.session, "after_rollback")
+def forget_pending_metric_devices(session):
+    session.info.pop("metric_device_ids", None)
+
+def report_metric_values(report):
+    """(mean, min, max) per metric for one report. With the agent's per-window
+    aggregates the extremes between reports are kept; otherwise it is the
+    single reading."""
+    aggregates = {a.metric: a for a in report.aggregates}
+    values = {}
+    for metric in METRICS:
+        agg = aggregates.get(metric)
+        last = getattr(report, metric)
+        if agg is not None and agg.mean is not None:
+            values[metric] = (agg.mean, agg.min, agg.max)
+        elif last is not None:
+            values[metric] = (last, last, last)
+    return values
+
+def record_metrics(reports):
+    reports = [r for r in reports if r.hostname and r.timestamp]
+    if not reports:
+        return
+
+    latest = {}
+    buckets = {}    # (resolution, device id, bucket) -> accumulated row
+    for report in reports:
+        device_id = metric_device_id(report.hostname)
+        if report.hostname not in latest or report.timestamp > latest[report.hostname].timestamp:
+            latest[report.hostname] = report
+        values = report_metric_values(report)
+        for resolution in METRIC_ROLLUPS:
+            key = (resolution, device_id, bucket_start(report.timestamp, resolution))
+            row = buckets.setdefault(key, {"count": 0, **{f"{metric}_count": 0 for metric in METRICS}})
+            row["count"] += 1
+            for metric, (mean, low, high) in values.items():
+                row[f"{metric}_count"] += 1
+                row[f"{metric}_sum"] = row.get(f"{metric}_sum", 0.0) + mean
+                row[f"{metric}_min"] = low if row.get(f"{metric}_min") is None else min(row[f"{metric}_min"], low)
+                row[f"{metric}_max"] = high if row.get(f"{metric}_max") is None else max(row[f"{metric}_max"], high)
+
+    for (resolution, device_id, bucket), row in buckets.items():
+        model = METRIC_ROLLUPS[resolution][0]
+        stmt = upsert(model).values(device_id=device_id, bucket=bucket, **row)
+        new = stmt.excluded
+        merged = {"count": model.count + new.count}
+        for metric in METRICS:
+            count, total, low, high = (getattr(model, f"{metric}_{f}") for f in ("count", "sum", "min", "max"))
+            new_count, new_total, new_low, new_high = (getattr(new, f"{metric}_{f}") for f in ("count", "sum", "min", "max"))
+            merged[f"{metric}_count"] = count + new_count
+            merged[f"{metric}_sum"] = func.coalesce(total, 0.0) + func.coalesce(new_total, 0.0)
+            merged[f"{metric}_min"] = case((low.is_(None), new_low), (new_low < low, new_low), else_=low)
+            merged[f"{metric}_max"] = case((high.is_(None), new_high), (new_high > high, new_high), else_=high)
+        db.session.execute(stmt.on_conflict_do_update(index_elements=["device_id", "bucket"], set_=merged))
+
+    for hostname, report in latest.items():
+        MetricDevice.query.filter(
+            MetricDevice.hostname == hostname,
+            or_(MetricDevice.last_seen.is_(None), MetricDevice.last_seen < report.timestamp)
+        ).update({"os": report.os, "ip": report.ip, "status": report.status, "last_seen": report.timestamp},
+                 synchronize_session=False)
+
+def rolled_up_reports(state):
+    """Raw reports already folded into the rollups (see MetricRollupState)."""
+    return or_(DeviceReport.id > state.legacy_max_id, DeviceReport.id <= state.backfilled_through_id)
+
+def purge_expired_metrics():
+    """One bounded retention pass, committing after every chunk. Returns the
+    number of rows deleted."""
+    now = datetime.utcnow()
+    state = db.session.get(MetricRollupState, 1)
+    deleted = 0
+    for _ in range(METRIC_PURGE_MAX_CHUNKS):
+        ids = [report_id for report_id, in db.session.query(DeviceReport.id).filter(
+            DeviceReport.timestamp < now - METRIC_RETENTION["raw"], rolled_up_reports(state)
+        ).limit(METRIC_PURGE_CHUNK)]
+        if not ids:
+            break
+        ReportAggregate.query.filter(ReportAggregate.report_id.in_(ids)).delete(synchronize_session=False)
+        DeviceReport.query.filter(DeviceReport.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+
+    for resolution, (model, _) in METRIC_ROLLUPS.items():
+        for _ in range(METRIC_PURGE_MAX_CHUNKS):
+            keys = db.session.query(model.device_id, model.bucket).filter(
+                model.bucket < now - METRIC_RETENTION[resolution]
+            ).limit(METRIC_PURGE_CHUNK).all()
+            if not keys:
+                break
+            model.query.filter(tuple_(model.device_id, model.bucket).in_(keys)).delete(synchronize_session=False)
+            db.session.commit()
+            deleted += len(keys)
+    return deleted
+
+def run_metric_retention():
+    while True:
+        try:
+            with app.app_context():
+                purge_expired_metrics()
+        except Exception as e:
+            print(f"[ERROR] Metric retention pass failed: {e}")
+        time.sleep(METRIC_PURGE_INTERVAL)
+
+def start_metric_retention():
+    with metric_retention_lock:
+        if metric_retention[0] is None:
+            metric_retention[0] = threading.Thread(target=run_metric_retention, name="metric-retention", daemon=True)
+            metric_retention[0].start()
+
+def parse_time_arg(name):
+    value = request.args.get(name)
+    return datetime.fromisoformat(value) if value else None
+
+def pick_resolution(span):
+    if span <= timedelta(hours=6):
+        return "1m"
+    if span <= timedelta(days=30):
+        return "1h"
+    return "1d"
+
+@app.route('/api/devices/<hostname>/metrics', methods=['GET'])
+def get_device_metrics(hostname):
+    try:
+        end = parse_time_arg("end") or datetime.utcnow()
+        start = parse_time_arg("start") or end - timedelta(hours=24)
+    except ValueError:
+        return jsonify({"error": "start and end must be ISO timestamps"}), 400
+    resolution = request.args.get("resolution", "auto")
+    if resolution == "auto":
+        resolution = pick_resolution(end - start)
+    if resolution != "raw" and resolution not in METRIC_ROLLUPS:
+        return jsonify({"error": f"resolution must be auto, raw or one of {list(METRIC_ROLLUPS)}"}), 400
+
+    if resolution == "raw":
+        rows = DeviceReport.query.filter(
+            DeviceReport.hostname == hostname,
+            DeviceReport.timestamp >= start,
+            DeviceReport.timestamp <= end
+        ).order_by(DeviceReport.timestamp).all()
+        points = [{"t": r.timestamp.isoformat(), "cpu": r.cpu, "ram": r.ram, "disk": r.disk} for r in rows]
+    else:
+        device = MetricDevice.query.filter_by(hostname=hostname).first()
+        if not device:
+            return jsonify({"error": "no metrics for this device"}), 404
+        model = METRIC_ROLLUPS[resolution][0]
+        rows = model.query.filter(
+            model.device_id == device.id,
+            model.bucket >= bucket_start(start, resolution),
+            model.bucket <= end
+        ).order_by(model.bucket).all()
+        points = [{
+            "t": r.bucket.isoformat(),
+            "count": r.count,
+            **{metric: {
+                "mean": round(getattr(r, f"{metric}_sum") / getattr(r, f"{metric}_count"), 2)
+                        if getattr(r, f"{metric}_count") else None,
+                "min": getattr(r, f"{metric}_min"),
+                "max": getattr(r, f"{metric}_max"),
+            } for metric in METRICS},
+        } for r in rows]
+
+    return jsonify({
+        "hostname": hostname,
+        "resolution": resolution,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "points": points,
+    })
+
+# ---------------- FLEET STATUS ----------------
+# Dashboard counters come from metric_devices: one row per host, with
+# last_seen kept up to date on ingest and indexed. The cost grows with the
+# number of hosts, not with report history, and every worker sees the same
+# committed state.
+
+ONLINE_WINDOW = timedelta(minutes=2)  # adjust as per agent interval
+
+def fleet_counts():
+    """(total, online)."""
+    total = db.session.query(func.count(MetricDevice.id)).scalar()
+    online = db.session.query(func.count(MetricDevice.id)).filter(
+        MetricDevice.last_seen > datetime.utcnow() - ONLINE_WINDOW
+    ).scalar()
+    return total, online
+
+@app.cli.command("backfill-metrics")
+def backfill_metrics():
+    """Fold reports stored before the rollup tables existed into them.
+    Resumable: progress is committed with every batch."""
+    state = db.session.get(MetricRollupState, 1)
+    while state.backfilled_through_id < state.legacy_max_id:
+        batch = DeviceReport.query.filter(
+            DeviceReport.id > state.backfilled_through_id,
+            DeviceReport.id <= state.legacy_max_id
+        ).order_by(DeviceReport.id).limit(METRIC_BACKFILL_BATCH).all()
+        state.backfilled_through_id = batch[-1].id if batch else state.legacy_max_id
+        record_metrics(batch)
+        db.session.commit()
+        print(f"Backfilled reports up to id {state.backfilled_through_id} of {state.legacy_max_id}")
+
+@app.cli.command("purge-metrics")
+def purge_metrics():
+    """Run retention passes until nothing expired is left."""
+    while True:
+        deleted = purge_expired_metrics()
+        print(f"Deleted {deleted} expired rows")
+        if not deleted:
+            break
+
+# ---------------- AGENT SYNC ----------------
+# One round trip per agent cycle: the agent posts whatever snapshots it
+# collected plus acknowledgements for commands it ran since the last sync,
+# and gets back every pending command, policy and setting in one response.
+
+@app.route('/api/devices/<device_id>/sync', methods=['POST'])
+def agent_sync(device_id):
+    data = request.get_json(silent=True) or {}
+    response = {}
+
+    # Acks first, so commands the agent already ran are not handed out again.
+    apply_agent_acks(device_id, data.get("acks") or {})
+
+    if data.get("report"):
+        error = validate_report(data["report"])
+        if error:
+            response["report"] = {"error": error, "code": 400}
+        else:
+            # A full queue must not lose the report or the commands in this
+            # response, so write it inline, which also slows this agent down
+            received_at = datetime.utcnow()
+            if not enqueue_report(data["report"], received_at):
+                save_device_report(data["report"], received_at)
+            response["report"] = {"message": "Report queued", "code": 202}
+    if data.get("transport"):
+        device_store.setdefault(device_id, {"id": device_id})["transport"] = data["transport"]
+    if data.get("kill_stats"):
+        device_store.setdefault(device_id, {"id": device_id})["kill_stats"] = data["kill_stats"]
+    if data.get("overruns"):
+        device_store.setdefault(device_id, {"id": device_id})["collector_overruns"] = data["overruns"]
+    if data.get("profile"):
+        device_store.setdefault(device_id, {"id": device_id})["agent_profile"] = data["profile"]
+    if data.get("governor"):
+        device_store.setdefault(device_id, {"id": device_id})["governor"] = data["governor"]
+    if data.get("inventory"):
+        body, status = apply_inventory(device_id, data["inventory"])
+        response["inventory"] = {**body, "code": status}
+    if "extensions" in data:
+        save_extensions(device_id, data["extensions"])
+    if "services" in data:
+        device_services_store[device_id] = data["services"]
+    if data.get("software"):
+        body, status = apply_software_delta(device_id, data["software"])
+        response["software"] = {**body, "code": status}
+    if data.get("processes"):
+        save_process_snapshot(device_id, data["processes"])
+
+    # Agents that leave commands to their command channel say so, and nothing
+    # is leased to a sync that will not run it.
+    response.update(pending_agent_commands(device_id, lease=data.get("commands", True)))
+    return jsonify(response)
+
+@app.route('/api/devices/<device_id>/agent-profile', methods=['GET'])
+def get_agent_profile(device_id):
+    device = device_store.get(device_id, {})
+    return jsonify({
+        "profile": device.get("agent_profile", {}),
+        "transport": device.get("transport", {}),
+        "collector_overruns": device.get("collector_overruns", {}),
+        "kill_stats": device.get("kill_stats", {}),
+        "governor": device.get("governor", {}),
+    })
+
+def apply_agent_acks(device_id, acks):
+    if acks.get("ids"):
+        ack_command_ids(device_id, acks["ids"])
+
+    # Value acks from agents that predate command ids.
+    if acks.get("removals"):
+        ack_commands_by_payload(device_id, ("removal",), acks["removals"])
+    if acks.get("service_actions"):
+        ack_commands_by_payload(device_id, ("service_action",), acks["service_actions"])
+    if acks.get("actions"):
+        ack_commands_by_payload(device_id, ("action",), acks["actions"])
+    if acks.get("process_kills"):
+        ack_commands_by_payload(device_id, ("process_kill",), acks["process_kills"], key=lambda p: p.get("name"))
+    if acks.get("system_actions"):
+        ack_commands_by_payload(device_id, ("system_action",), acks["system_actions"], one_each=True)
+
+    if acks.get("patch_result"):
+        store_patch_result(device_id, acks["patch_result"])
+
+@app.route('/api/devices/<device_id>/commands', methods=['GET'])
+def list_device_commands(device_id):
+    kinds = tuple(COMMAND_LISTS)
+    return jsonify([{
+        "id": c.id,
+        "kind": c.kind,
+        "payload": c.payload,
+        "attempts": c.attempts,
+        "leased_until": c.lease_until.isoformat() if c.lease_until else None,
+        "created_at": c.created_at.isoformat() if c.created_at else None,
+    } for c in active_commands(device_id, kinds)])
+
+@app.route('/api/devices/<device_id>/commands/ack', methods=['POST'])
+def ack_device_commands(device_id):
+    data = request.get_json(silent=True) or {}
+    return jsonify({"acked": ack_command_ids(device_id, data.get("ids") or [])})
+
+# ---------------- COMMAND CHANNEL ----------------
+LONG_POLL_MAX = 30
+# Commands queued through another worker do not wake this worker's waiters,
+# so a waiter also checks the queue table this often.
+COMMAND_POLL_SLICE = 5
+
+@app.route('/api/devices/<device_id>/commands/wait', methods=['POST'])
+def wait_for_commands(device_id):
+    """Long-poll: holds the request until a command is queued for this device
+    (its counter moves past `since`) or the timeout expires."""
+    data = request.get_json(silent=True) or {}
+    since, timeout = begin_command_wait(device_id, data)
+    deadline = time.monotonic() + timeout
+    cond = device_condition(device_id)
+    while not commands_ready(device_id, since):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return jsonify(command_wait_response(device_id, since, ready=False))
+        # End the read transaction so the next check sees other workers' commits.
+        db.session.rollback()
+        with cond:
+            cond.wait_for(lambda: command_seq.get(device_id, 0) != since, min(remaining, COMMAND_POLL_SLICE))
+
+    return jsonify(command_wait_response(device_id, since))
+
+# The long-poll in three steps, shared with the asyncio ingest server, which
+# waits between them without holding a thread.
+def begin_command_wait(device_id, data):
+    """Apply the acks the poll carries; returns (since, timeout)."""
+    apply_agent_acks(device_id, data.get("acks") or {})
+    return data.get("since"), min(float(data.get("timeout", LONG_POLL_MAX)), LONG_POLL_MAX)
+
+def commands_ready(device_id, since):
+    return since is None or command_seq.get(device_id, 0) != since or has_deliverable_commands(device_id)
+
+def command_wait_response(device_id, since, ready=True):
+    # A poll that timed out checks once more: a notify racing the timeout must
+    # not move the agent's seq past a change it was never sent.
+    if not ready and not commands_ready(device_id, since):
+        return {"seq": since}
+    return {"seq": command_seq.get(device_id, 0), **pending_agent_commands(device_id)}
+
+def extension_policy_for(device_id):
+    whitelist, blacklist = {}, []
+    for p in ExtensionPolicy.query.filter_by(device_id=device_id).all():
+        if p.ext_type == 'blacklist':
+            blacklist.append(p.name)
+        elif p.mode == 'whitelist':
+            whitelist.setdefault(p.ext_type, []).append(p.name)
+    return {"whitelist": whitelist, "blacklist": blacklist}
+
+def pending_agent_commands(device_id, lease=True):
+    response = {
+        "extension_policy": extension_policy_for(device_id),
+        "enable_usb": usb_enable_active(device_id),
+        "schedule": merged_agent_schedule(device_id),
+    }
+    if not lease:
+        return response
+
+    leased = lease_commands(device_id)
+    for name in set(COMMAND_LISTS.values()):
+        response[name] = []
+    for command in leased + active_commands(device_id, STANDING_KINDS):
+        response[COMMAND_LISTS[command.kind]].append(command.payload)
+    # Ids let the agent ack exactly what it ran ("ids" in its acks).
+    response["commands"] = [{"id": c.id, "kind": c.kind, "payload": c.payload} for c in leased]
+    return response
 
 # --------------------- RUN ---------------------
+# Agents can talk to the ingest server (ingest_server.py) instead, so a burst
+# of check-ins does not hold up the dashboard's request threads. `python app.py`
+# always starts it; under `flask run` or a WSGI server it starts when
+# INGEST_PORT is set. Each worker process then runs its own listener on the
+# shared port. Agents choose the port through AGENT_SERVER_URL.
+INGEST_PORT = int(os.environ.get("INGEST_PORT") or 5001)
+
+def start_ingest_server():
+    import ingest_server
+    ingest_server.start_in_thread(sys.modules[__name__], host='0.0.0.0', port=INGEST_PORT)
+
 if __name__ == '__main__':
+    start_ingest_server()
     app.run(host='0.0.0.0', port=5000)
+elif os.environ.get("INGEST_PORT"):
+    start_ingest_server()
 
 print("🔧 Flask is loading this app.py")
 print(app.url_map)
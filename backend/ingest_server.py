@@ -0,0 +1,325 @@
+"""Agent-facing ingestion server.
+
+Serves only the routes agents call (reports, sync, inventory/software/
+services/extensions uploads, the pending-* polls and the command long-poll)
+on their own port, from one asyncio event loop. The loop owns every socket:
+idle keep-alive connections and parked long-polls cost a coroutine, not a
+thread. Route handlers are the Flask views in app.py, run on a small thread
+pool, so both servers share the models, the database and the in-memory
+stores. The dashboard API keeps the Flask server's threads to itself.
+
+Long-polls (/commands/wait) never occupy a pool thread while they wait. They
+wake on notify_device() in this process, and one batched query per
+INGEST_POLL_INTERVAL picks up commands queued by other processes.
+
+Started from app.py (see RUN: always under `python app.py`, and under any
+other server when INGEST_PORT is set), or embedded elsewhere with
+start_in_thread(app_module, host, port). Listeners use SO_REUSEPORT, so every
+worker process of a multi-process server can run one on the same port.
+"""
+import asyncio
+import io
+import json
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from werkzeug.exceptions import HTTPException
+
+INGEST_WORKERS = 8              # threads running Flask views / DB work
+INGEST_POLL_INTERVAL = 2        # seconds between queue checks for parked long-polls
+KEEPALIVE_TIMEOUT = 75          # idle seconds before a keep-alive connection is closed
+MAX_HEADERS = 100
+MAX_BODY = 64 * 1024 * 1024
+POLL_QUERY_CHUNK = 500          # device ids per IN (...) when checking the queue
+
+# Flask endpoints (view function names) reachable through this server.
+AGENT_ENDPOINTS = frozenset({
+    "report_device", "receive_report_batch", "agent_sync",
+    "receive_inventory", "receive_extensions", "receive_software", "receive_software_delta",
+    "receive_services", "receive_processes", "receive_patch_result",
+    "get_policy", "get_blacklist", "get_pending_removals", "get_software_pending_removal",
+    "get_pending_service_actions", "clear_completed_service_actions",
+    "get_pending_process_kills", "clear_kill_queue", "delete_pending_kill",
+    "get_pending_actions", "get_pending_system_actions", "get_usb_enable_pending",
+    "list_device_commands", "ack_device_commands", "wait_for_commands",
+})
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error", 501: "Not Implemented"}
+
+
+class BadRequest(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def json_response(status, payload, extra_headers=()):
+    body = json.dumps(payload).encode()
+    headers = [("Content-Type", "application/json"), *extra_headers]
+    return f"{status} {REASONS.get(status, '')}", headers, body
+
+
+async def read_line(reader, timeout=None):
+    # readline() raises ValueError when a line outgrows the stream's buffer limit
+    try:
+        return await asyncio.wait_for(reader.readline(), timeout)
+    except ValueError:
+        raise BadRequest(400, "Request line or header too long")
+
+
+async def read_request(reader):
+    """One HTTP/1.x request off the stream: (method, target, version, headers,
+    body), or None when the client closed an idle connection."""
+    line = await read_line(reader, KEEPALIVE_TIMEOUT)
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise BadRequest(400, "Malformed request line")
+
+    headers = {}
+    while True:
+        line = await read_line(reader)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise BadRequest(400, "Too many headers")
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "identity").lower() != "identity":
+        raise BadRequest(501, "Chunked request bodies are not supported; send Content-Length")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise BadRequest(400, "Invalid Content-Length")
+    if length < 0:
+        raise BadRequest(400, "Invalid Content-Length")
+    if length > MAX_BODY:
+        raise BadRequest(413, "Request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, version, headers, body
+
+
+def keep_alive(version, headers):
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+
+class IngestServer:
+    def __init__(self, backend, host, port):
+        self.backend = backend          # the app.py module
+        self.app = backend.app
+        self.host = host
+        self.port = port
+        self.pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+        self.adapter = self.app.url_map.bind("localhost")
+        self.waiters = {}               # device id -> set of futures for parked long-polls
+        self.loop = None
+
+    # ---- connections ----
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info("peername") or ("", 0)
+        try:
+            while True:
+                try:
+                    parsed = await read_request(reader)
+                except BadRequest as e:
+                    await self.send(writer, json_response(e.status, {"error": str(e)}), False)
+                    break
+                if parsed is None:
+                    break
+                method, target, version, headers, body = parsed
+                persistent = keep_alive(version, headers)
+                try:
+                    response = await self.dispatch(method, target, version, headers, body, peer)
+                except Exception:
+                    traceback.print_exc()
+                    response = json_response(500, {"error": "Internal server error"})
+                await self.send(writer, response, persistent)
+                if not persistent:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, writer, response, persistent):
+        status, headers, body = response
+        lines = [f"HTTP/1.1 {status}"]
+        lines += [f"{name}: {value}" for name, value in headers
+                  if name.lower() not in ("content-length", "connection", "transfer-encoding")]
+        lines += [f"Content-Length: {len(body)}", f"Connection: {'keep-alive' if persistent else 'close'}"]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    # ---- routing ----
+
+    async def dispatch(self, method, target, version, headers, body, peer):
+        path, _, query = target.partition("?")
+        path = unquote(path, encoding="latin-1")
+        try:
+            endpoint, args = self.adapter.match(path, method)
+        except HTTPException as e:
+            return json_response(e.code if e.code in REASONS else 404, {"error": e.name})
+        if endpoint not in AGENT_ENDPOINTS:
+            return json_response(404, {"error": "Not Found"})
+
+        environ = self.environ(method, path, query, version, headers, body, peer)
+        if endpoint == "wait_for_commands":
+            return await self.wait_for_commands(environ, args["device_id"])
+        return await self.run(self.call_wsgi, environ)
+
+    def environ(self, method, path, query, version, headers, body, peer):
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0],
+            "REMOTE_PORT": str(peer[1]),
+            "CONTENT_TYPE": headers.get("content-type", ""),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers.items():
+            if name not in ("content-type", "content-length"):
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        return environ
+
+    async def run(self, fn, *args):
+        return await self.loop.run_in_executor(self.pool, fn, *args)
+
+    def call_wsgi(self, environ):
+        captured = {}
+
+        def start_response(status, headers, exc_info=None):
+            captured["status"], captured["headers"] = status, headers
+
+        result = self.app(environ, start_response)
+        try:
+            body = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return captured["status"], captured["headers"], body
+
+    # ---- long-poll ----
+
+    def begin_wait(self, environ, device_id):
+        error = self.backend.decode_request_body(environ)
+        if error:
+            return error, None, None
+        with self.app.request_context(environ):
+            data = self.backend.request.get_json(silent=True) or {}
+            since, timeout = self.backend.begin_command_wait(device_id, data)
+            ready = self.backend.commands_ready(device_id, since)
+        return None, since, 0 if ready else timeout
+
+    def finish_wait(self, device_id, since, ready):
+        with self.app.app_context():
+            return self.backend.command_wait_response(device_id, since, ready=ready)
+
+    async def wait_for_commands(self, environ, device_id):
+        error, since, timeout = await self.run(self.begin_wait, environ, device_id)
+        if error:
+            status, message = error
+            return status, [("Content-Type", "text/plain")], message.encode()
+
+        ready = True
+        if timeout > 0:
+            future = self.loop.create_future()
+            self.waiters.setdefault(device_id, set()).add(future)
+            # A notify between begin_wait and here found no waiter to wake
+            if self.backend.command_seq.get(device_id, 0) != since:
+                future.set_result(True)
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                ready = False
+            finally:
+                parked = self.waiters.get(device_id)
+                if parked is not None:
+                    parked.discard(future)
+                    if not parked:
+                        del self.waiters[device_id]
+
+        payload = await self.run(self.finish_wait, device_id, since, ready)
+        return json_response(200, payload, [("X-Accept-Body", self.backend.ACCEPTED_BODY_ENCODINGS)])
+
+    def wake(self, device_id):
+        for future in self.waiters.get(device_id, ()):
+            if not future.done():
+                future.set_result(True)
+
+    def notify_threadsafe(self, device_id):
+        # Called from whichever thread queued a command (see notify_device).
+        if device_id in self.waiters:
+            self.loop.call_soon_threadsafe(self.wake, device_id)
+
+    def ready_devices(self, device_ids):
+        ready = set()
+        with self.app.app_context():
+            for i in range(0, len(device_ids), POLL_QUERY_CHUNK):
+                ready |= self.backend.devices_with_deliverable_commands(device_ids[i:i + POLL_QUERY_CHUNK])
+        return ready
+
+    async def poll_queue(self):
+        """Wake parked long-polls whose commands were queued by another process."""
+        while True:
+            await asyncio.sleep(INGEST_POLL_INTERVAL)
+            if not self.waiters:
+                continue
+            try:
+                for device_id in await self.run(self.ready_devices, list(self.waiters)):
+                    self.wake(device_id)
+            except Exception as e:
+                print(f"[ERROR] Ingest queue poll failed: {e}")
+
+    # ---- lifecycle ----
+
+    async def serve(self, started=None):
+        self.loop = asyncio.get_running_loop()
+        self.backend.command_listeners.append(self.notify_threadsafe)
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=4096,
+                                            reuse_port=True)
+        self.loop.create_task(self.poll_queue())
+        print(f"[INGEST] Serving agent routes on {self.host}:{self.port}")
+        if started is not None:
+            started.set()
+        async with server:
+            await server.serve_forever()
+
+
+def start_in_thread(backend, host="0.0.0.0", port=5001):
+    """Run the ingest server on its own event loop thread; returns once it is listening."""
+    server = IngestServer(backend, host, port)
+    started = threading.Event()
+
+    def run():
+        try:
+            asyncio.run(server.serve(started))
+        except OSError as e:
+            print(f"[ERROR] Ingest server could not listen on {host}:{port}: {e}")
+            started.set()
+
+    threading.Thread(target=run, name="ingest-server", daemon=True).start()
+    started.wait(10)
+    return server
@@ -13,6 +13,11 @@ class User(UserMixin, db.Model):
     role = db.Column(db.String(50), default='admin')  # e.g. admin, viewer, operator
 
 class DeviceReport(db.Model):
+    __table_args__ = (
+        db.Index('ix_device_report_host_time', 'hostname', 'timestamp'),
+        db.Index('ix_device_report_timestamp', 'timestamp'),   # retention sweeps
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     hostname = db.Column(db.String(100))
     os = db.Column(db.String(200))
@@ -22,6 +27,78 @@ class DeviceReport(db.Model):
     ram = db.Column(db.Float)
     disk = db.Column(db.Float)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    aggregates = db.relationship('ReportAggregate', backref='report', lazy='select', cascade='all, delete-orphan')
+
+
+class ReportAggregate(db.Model):
+    __tablename__ = 'report_aggregates'
+
+    # Downsampled agent readings over the window a report covers, one row per metric
+    id = db.Column(db.Integer, primary_key=True)
+    report_id = db.Column(db.Integer, db.ForeignKey('device_report.id'), nullable=False, index=True)
+    metric = db.Column(db.String(20))         # cpu, ram, disk
+    min = db.Column(db.Float)
+    max = db.Column(db.Float)
+    mean = db.Column(db.Float)
+    p95 = db.Column(db.Float)
+    last = db.Column(db.Float)
+    samples = db.Column(db.Integer)
+    window_seconds = db.Column(db.Float)
+
+
+class MetricDevice(db.Model):
+    __tablename__ = 'metric_devices'
+
+    # One row per reporting host, so rollups key on a small integer instead of
+    # repeating hostname/os/ip, plus the host's latest report
+    id = db.Column(db.Integer, primary_key=True)
+    hostname = db.Column(db.String(100), unique=True, nullable=False)
+    os = db.Column(db.String(200))
+    ip = db.Column(db.String(100))
+    status = db.Column(db.String(20))
+    last_seen = db.Column(db.DateTime, index=True)
+
+
+class MetricRollupMixin:
+    # Per-device CPU/RAM/disk over one bucket, updated in place on every report
+    device_id = db.Column(db.Integer, db.ForeignKey('metric_devices.id'), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True, index=True)
+    count = db.Column(db.Integer, nullable=False, default=0)     # reports in the bucket
+    # Per-metric counts: a report may leave any metric out
+    cpu_count = db.Column(db.Integer, nullable=False, default=0)
+    cpu_sum = db.Column(db.Float, default=0.0)
+    cpu_min = db.Column(db.Float)
+    cpu_max = db.Column(db.Float)
+    ram_count = db.Column(db.Integer, nullable=False, default=0)
+    ram_sum = db.Column(db.Float, default=0.0)
+    ram_min = db.Column(db.Float)
+    ram_max = db.Column(db.Float)
+    disk_count = db.Column(db.Integer, nullable=False, default=0)
+    disk_sum = db.Column(db.Float, default=0.0)
+    disk_min = db.Column(db.Float)
+    disk_max = db.Column(db.Float)
+
+
+class MetricRollup1m(MetricRollupMixin, db.Model):
+    __tablename__ = 'metric_rollups_1m'
+
+
+class MetricRollup1h(MetricRollupMixin, db.Model):
+    __tablename__ = 'metric_rollups_1h'
+
+
+class MetricRollup1d(MetricRollupMixin, db.Model):
+    __tablename__ = 'metric_rollups_1d'
+
+
+class MetricRollupState(db.Model):
+    __tablename__ = 'metric_rollup_state'
+
+    # Single row. Reports with id <= legacy_max_id were stored before rollups
+    # existed and only count as rolled up once the backfill has passed them.
+    id = db.Column(db.Integer, primary_key=True)
+    legacy_max_id = db.Column(db.Integer, nullable=False, default=0)
+    backfilled_through_id = db.Column(db.Integer, nullable=False, default=0)
 
 
 class ExtensionPolicy(db.Model):
@@ -33,8 +110,59 @@ class ExtensionPolicy(db.Model):
     name = db.Column(db.String(200))          # Extension name or ID
     mode = db.Column(db.String(20))           # whitelist or blacklist
 
+class PendingCommand(db.Model):
+    __tablename__ = 'pending_commands'
+    __table_args__ = (
+        # Per-device FIFO of unacknowledged commands
+        db.Index('ix_pending_commands_queue', 'device_id', 'acked_at', 'id'),
+        db.UniqueConstraint('device_id', 'idempotency_key', name='uq_pending_commands_idempotency'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    kind = db.Column(db.String(30), nullable=False)     # removal, service_action, action, process_kill, process_rule, system_action
+    payload = db.Column(db.JSON, nullable=False)        # exactly what the agent receives
+    idempotency_key = db.Column(db.String(200))
+    lease_token = db.Column(db.String(32))
+    lease_until = db.Column(db.DateTime)                # handed out; invisible to other fetches until then
+    attempts = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    acked_at = db.Column(db.DateTime)
+
+class InstalledSoftware(db.Model):
+    __tablename__ = 'installed_software'
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'name', name='uq_installed_software_device_name'),
+        # Inverted index: package (and version) -> devices that have it; covers searches
+        db.Index('ix_installed_software_name_version', 'name', 'version', 'device_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(255), nullable=False)
+    version = db.Column(db.String(200), nullable=False, default='')
+    item = db.Column(db.JSON, nullable=False)           # the agent's record, served back unchanged
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class DeviceSyncState(db.Model):
+    __tablename__ = 'device_sync_state'
+
+    # What each agent last synced, so deltas and usage-only inventory updates
+    # validate in any backend process and across restarts
+    device_id = db.Column(db.String(100), primary_key=True)
+    software_version = db.Column(db.String(64))     # snapshot version of installed_software
+    inventory_key = db.Column(db.String(200))       # agent's static-inventory cache key
+    inventory = db.Column(db.JSON)                  # the last full inventory body under that key
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class CommandLog(db.Model):
     __tablename__ = 'command_logs'
+    __table_args__ = (
+        # Newest-first keyset pages, whole fleet or filtered by device or user
+        db.Index('ix_command_logs_time', 'time', 'id'),
+        db.Index('ix_command_logs_device_time', 'device', 'time', 'id'),
+        db.Index('ix_command_logs_user_time', 'user', 'time', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user = db.Column(db.String(100), nullable=False)
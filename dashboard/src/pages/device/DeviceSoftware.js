@@ -2,9 +2,26 @@ import React, { useState, useEffect, useMemo } from 'react';
 import axios from 'axios';
 import { useParams } from 'react-router-dom';
 
+// The agent's process snapshot has one summary per process name plus the top
+// consumers; show each name as a running process, with its path when known.
+const processRows = (snapshot) => {
+  const paths = {};
+  (snapshot.top || []).forEach(p => { if (p.exe) paths[p.name] = p.exe; });
+  return Object.entries(snapshot.names || {}).map(([name, info]) => ({
+    name,
+    state: 'running',
+    type: 'process',
+    path: paths[name],
+    count: info.count,
+    cpu: info.cpu,
+    rss: info.rss
+  }));
+};
+
 export default function DeviceSoftware() {
   const { deviceId } = useParams();
   const [softwareList, setSoftwareList] = useState([]);
+  const [processes, setProcesses] = useState([]);
   const [services, setServices] = useState([]);
   const [filter, setFilter] = useState('all');
   const [search, setSearch] = useState('');
@@ -14,6 +31,10 @@ export default function DeviceSoftware() {
       .then(res => setSoftwareList(res.data))
       .catch(err => console.error(err));
 
+    axios.get(`/api/devices/${deviceId}/processes`)
+      .then(res => setProcesses(processRows(res.data)))
+      .catch(err => console.error(err));
+
     axios.get(`/api/devices/${deviceId}/services`)
       .then(res => setServices(res.data))
       .catch(err => console.error(err));
@@ -29,8 +50,8 @@ export default function DeviceSoftware() {
     axios.post(`/api/devices/${deviceId}/processes/${encodeURIComponent(name)}/kill`)
       .then(() => {
         alert(`${name} has been marked for termination.`);
-        axios.get(`/api/devices/${deviceId}/software`)
-          .then(res => setSoftwareList(res.data));
+        axios.get(`/api/devices/${deviceId}/processes`)
+          .then(res => setProcesses(processRows(res.data)));
       })
       .catch(err => console.error(err));
   };
@@ -53,13 +74,13 @@ export default function DeviceSoftware() {
     if (filter === 'running-services') {
       return services.filter(s => s.name.toLowerCase().includes(search.toLowerCase()));
     }
-    return softwareList.filter(s => {
+    return [...softwareList, ...processes].filter(s => {
       if (filter === 'running' && s.state !== 'running') return false;
       if (filter === 'installed' && s.state !== 'installed') return false;
       if (search && !s.name.toLowerCase().includes(search.toLowerCase())) return false;
       return true;
     });
-  }, [filter, search, softwareList, services]);
+  }, [filter, search, softwareList, processes, services]);
 
   const stateColor = {
     running: 'bg-green-100 text-green-800',
@@ -138,7 +159,11 @@ export default function DeviceSoftware() {
                 <div className="flex justify-between items-start">
                   <div>
                     <h4 className="font-semibold text-gray-900 text-base">{s.name}</h4>
-                    <p className="text-sm text-gray-500 mb-1">Version: {s.version || 'N/A'}</p>
+                    {s.type === 'process' ? (
+                      <p className="text-sm text-gray-500 mb-1">Instances: {s.count} | CPU: <strong>{s.cpu}%</strong> | RAM: <strong>{(s.rss / 1048576).toFixed(1)} MB</strong></p>
+                    ) : (
+                      <p className="text-sm text-gray-500 mb-1">Version: {s.version || 'N/A'}</p>
+                    )}
                     <p className="text-sm text-gray-500">Path: {s.path || 'N/A'}</p>
                     <p className="text-sm text-gray-500">Type: {s.type || 'N/A'}</p>
                   </div>